@@ -6,20 +6,35 @@ to be posted to Mastodon and/or Twitter
 
 import configparser
 import hashlib
+import html
 import logging
+import math
+import multiprocessing
 import os
+import queue
 import re
 import sys
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from dataclasses import replace
+from itertools import chain
+from typing import Dict
 from typing import List
 from typing import Optional
-from urllib.error import URLError
+from typing import Tuple
+from urllib.parse import parse_qs
+from urllib.parse import urljoin
 from urllib.parse import urlsplit
-from urllib.request import urlopen
+from xml.etree import ElementTree
 
 import praw
 import prawcore.exceptions
 import requests
 from PIL import Image as PILImage
+from PIL import ImageOps
 from bs4 import BeautifulSoup
 from gfycat.client import GfycatClient
 from gfycat.error import GfycatClientError
@@ -28,43 +43,377 @@ from imgurpython.helpers.error import ImgurClientError
 from praw.models import Submission
 
 from control import Configuration
+from control import PERCEPTUAL_HASH_PREFIX
+from control import PostRecorder
+from control import SubredditConfig
+from control import distinctive_perceptual_hash
+from network import HttpClient
 
 FATAL_TOOTBOT_ERROR = 'Tootbot cannot continue, now shutting down'
+# Rough size of a compressed image per pixel, reddit listings only tell the dimensions
+IMAGE_BYTES_PER_PIXEL = 0.5
+
+
+@dataclass
+class DownloadedFile:
+    """
+    Dataclass holding details of a downloaded media file. Path is None if the download has been
+    skipped because the media file has already been posted.
+    """
+    path: Optional[str]
+    checksum: str
+    size: int
+
+
+@dataclass
+class MediaTriage:
+    """
+    Dataclass holding what the reddit listing tells about the media of a submission before any of
+    it is downloaded. Media type is one of 'image', 'gif' or 'video', an empty string if the
+    submission might link to media of unknown type, or None if it has no media. Estimated size is
+    in bytes, 0 if unknown. Reason is empty unless the media can't be posted.
+    """
+    media_type: Optional[str]
+    estimated_size: int
+    reason: str = ''
+
+    @property
+    def postable(self) -> bool:
+        """
+        True if the submission is expected to have media that can be posted.
+        """
+        return self.media_type is not None and not self.reason
+
+
+def image_rendition(width: int, height: int, url: str) -> Tuple[int, int, str]:
+    """
+    Describes one rendition of an image listed by reddit for choose_rendition.
+
+        Arguments:
+            width (int): width of image in pixels
+            height (int): height of image in pixels
+            url (string): url of image as listed by reddit, with HTML entities
+
+        Returns:
+            rendition (Tuple[int, int, str]): pixels, estimated size in bytes and url
+    """
+    pixels = width * height
+    return pixels, int(pixels * IMAGE_BYTES_PER_PIXEL), html.unescape(url)
+
+
+def rendition_fits(rendition: Tuple[int, int, str], max_bytes: int, max_pixels: int) -> bool:
+    """
+    Checks if a rendition fits into a byte and pixel budget. Limits of 0 mean no limit.
+    """
+    return (max_bytes <= 0 or rendition[1] <= max_bytes) and \
+        (max_pixels <= 0 or rendition[0] <= max_pixels)
+
+
+def choose_rendition(renditions: List[Tuple[int, int, str]], max_bytes: int,
+                     max_pixels: int) -> Optional[Tuple[int, int, str]]:
+    """
+    Chooses the best rendition of a media file that fits into a byte and pixel budget.
+
+        Arguments:
+            renditions (List[Tuple[int, int, str]]): pixels, size in bytes and url of each
+                rendition available
+            max_bytes (int): largest file size allowed, 0 for no limit
+            max_pixels (int): largest number of pixels allowed, 0 for no limit
+
+        Returns:
+            rendition (Tuple[int, int, str]): rendition with the most pixels that fits the budget,
+                the smallest rendition if none fits, or None if there are no renditions
+    """
+    if not renditions:
+        return None
+    fitting = [rendition for rendition in renditions
+               if rendition_fits(rendition, max_bytes, max_pixels)]
+    if fitting:
+        return max(fitting)
+    return min(renditions)
+
+
+def rendition_file_name(url: str, default_extension: str) -> str:
+    """
+    Determines a file name for a rendition served by preview.redd.it. Their format can differ from
+    the extension in their url and is given by the format parameter instead.
+
+        Arguments:
+            url (string): url of rendition
+            default_extension (string): extension to use if the url has no format parameter
+
+        Returns:
+            file_name (string): file name with extension matching format of rendition
+    """
+    url_parts = urlsplit(url)
+    base_name, extension = os.path.splitext(os.path.basename(url_parts.path))
+    image_format = parse_qs(url_parts.query).get('format', [''])[0].lower()
+    if image_format in ('jpg', 'pjpg', 'jpeg'):
+        extension = '.jpg'
+    elif image_format in ('png', 'png8'):
+        extension = '.png'
+    elif image_format:
+        extension = '.' + image_format
+    return base_name + (extension or default_extension)
+
+
+def sniff_media_type(first_bytes: bytes) -> Optional[str]:
+    """
+    Determines the mime type of a media file from the signature in its first bytes.
+
+        Arguments:
+            first_bytes (bytes): at least the first 12 bytes of the file
+
+        Returns:
+            mime_type (string): mime type of file or None if file is not a supported media type
+    """
+    if first_bytes.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if first_bytes.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if first_bytes.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    if first_bytes.startswith(b'RIFF') and first_bytes[8:12] == b'WEBP':
+        return 'image/webp'
+    if first_bytes[4:8] == b'ftyp':
+        # ISO base media files are images if their major brand says so
+        if first_bytes[8:12] in (b'avif', b'avis'):
+            return 'image/avif'
+        if first_bytes[8:12] in (b'heic', b'heix', b'mif1'):
+            return 'image/heic'
+        return 'video/mp4'
+    if first_bytes.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'video/webm'
+    return None
+
+
+def perceptual_hash(file_path: str) -> Optional[str]:
+    """
+    Calculates a 64 bit difference hash (dHash) of an image. Unlike a checksum it stays the same
+    or changes in only a few bits when the image is resized, re-compressed or converted to another
+    format. Animated images are hashed by their first frame.
+
+        Arguments:
+            file_path (string): path of image file
+
+        Returns:
+            perceptual_hash (string): hash prefixed with PERCEPTUAL_HASH_PREFIX or None if file is
+            not an image Pillow can read or the image is too flat to be told apart from others
+    """
+    try:
+        with PILImage.open(file_path) as img:
+            # Hash the image the way it is displayed, normalized images are stored that way
+            pixels = list(ImageOps.exif_transpose(img).convert('L')
+                          .resize((9, 8), PILImage.LANCZOS).getdata())
+    except (OSError, ValueError, PILImage.DecompressionBombError):
+        return None
+
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            value = (value << 1) | (left > pixels[row * 9 + column + 1])
+    if not distinctive_perceptual_hash(value):
+        return None
+    return '%s%016x' % (PERCEPTUAL_HASH_PREFIX, value)
+
+
+def normalize_image(file_path: str, max_pixels: int, max_size: int, quality: int) -> str:
+    """
+    Normalizes a downloaded image before it is uploaded. The image is rotated according to its
+    EXIF orientation, scaled down to at most max_pixels, stripped of EXIF and other metadata and
+    recompressed. Photos are saved as JPEG with quality lowered in steps until they are no larger
+    than max_size, images with transparency as optimized PNG. Animated images, videos and files
+    Pillow can't read are left as they are.
+    This runs in a separate process, so it must not rely on any state of the main process.
+
+        Arguments:
+            file_path (string): path of downloaded file
+            max_pixels (int): maximum number of pixels, 0 for no limit
+            max_size (int): target file size in bytes, 0 for no limit
+            quality (int): JPEG quality to start with
+
+        Returns:
+            file_path (string): path of normalized image, or file_path if it has been left as is.
+            The original file is removed if a normalized image has been written.
+    """
+    base_name = os.path.splitext(file_path)[0]
+    try:
+        with PILImage.open(file_path) as img:
+            if getattr(img, 'is_animated', False) or img.format not in ('JPEG', 'PNG', 'WEBP'):
+                return file_path
+            has_metadata = any(key in img.info for key in ('exif', 'xmp', 'comment',
+                                                           'XML:com.adobe.xmp'))
+            has_alpha = img.mode in ('RGBA', 'LA', 'PA') or \
+                (img.mode == 'P' and 'transparency' in img.info)
+            icc_profile = img.info.get('icc_profile')
+            image = ImageOps.exif_transpose(img)
+
+            pixels = image.width * image.height
+            resized = 0 < max_pixels < pixels
+            if resized:
+                scale = math.sqrt(max_pixels / pixels)
+                image = image.resize((max(1, int(image.width * scale)),
+                                      max(1, int(image.height * scale))), PILImage.LANCZOS)
+
+            if has_alpha:
+                new_path = base_name + '-normalized.png'
+                image.convert('RGBA').save(new_path, 'PNG', optimize=True,
+                                           icc_profile=icc_profile)
+            else:
+                new_path = base_name + '-normalized.jpg'
+                image = image.convert('RGB')
+                while True:
+                    image.save(new_path, 'JPEG', quality=quality, optimize=True,
+                               progressive=True, icc_profile=icc_profile)
+                    if max_size <= 0 or os.path.getsize(new_path) <= max_size or quality <= 50:
+                        break
+                    quality -= 10
+    except (OSError, ValueError, PILImage.DecompressionBombError):
+        return file_path
+
+    # Keep the original if normalizing didn't achieve anything
+    if not resized and not has_metadata and \
+            os.path.getsize(new_path) >= os.path.getsize(file_path):
+        os.remove(new_path)
+        return file_path
+    os.remove(file_path)
+    return new_path
 
 
 # Function for downloading images from a URL to media folder
-def save_file(img_url: str, file_path: str, logger: logging.Logger) -> Optional[str]:
+def save_file(img_url: str, file_path: str, logger: logging.Logger,
+              http_client: HttpClient, accepted_types: Tuple[str, ...] = None,
+              chunk_size: int = 1024 * 1024,
+              post_recorder: PostRecorder = None,
+              max_sizes: Dict[str, int] = None) -> Optional[DownloadedFile]:
     """
-    Utility method to save a file located at img_url to a file located at filepath
+    Utility method to save a file located at img_url to a file located at filepath. The SHA256
+    checksum of the file is calculated while it is being written. The type of the file is
+    determined from the signature in its first bytes and the download is abandoned before
+    anything is written if it is not a supported media type.
 
         Arguments:
             img_url (string): url of imgur image to download
             file_path (string): directory and filename where to save the downloaded image to
             logger (logger): logger to use for logging messages
+            http_client (HttpClient): shared HTTP client to download the file with
+            accepted_types (Tuple[str, ...]): [optional] mime types to accept. If given, the
+                download is abandoned before any of the file is read if the content type of the
+                response is not one of these, and before anything is written if the signature
+                in the first bytes of the file doesn't match one of these.
+            chunk_size (int): [optional] number of bytes to read and write at a time
+            post_recorder (PostRecorder): [optional] if given, the download is skipped if the url,
+                or the ETag and Content-Length of the response, are known for a media file that
+                has already been posted. Checksums of downloaded files are recorded with it.
+            max_sizes (Dict[str, int]): [optional] maximum size in bytes per top level media
+                type, e.g. 'image' or 'video'. 0 or no entry means no limit. Downloads are
+                abandoned as soon as the Content-Length or the bytes received exceed the limit.
 
         Returns:
-            file_path (string): path to downloaded image or None if no image was downloaded
+            downloaded_file (DownloadedFile): path, checksum and size of downloaded image or
+                None if no image was downloaded
     """
-    resp = requests.get(img_url, stream=True)
-    if resp.status_code == 200:
-        with open(file_path, 'wb') as image_file:
-            for chunk in resp:
-                image_file.write(chunk)
-        # Return the path of the image, which is always the same since we
-        # just overwrite images
-        image_file.close()
-        return file_path
-
-    logger.error('File failed to download. Status code: %s' % resp.status_code)
+    if post_recorder is not None:
+        known_checksum = post_recorder.known_media_checksum(media_url=img_url)
+        if known_checksum is not None and post_recorder.duplicate_check(known_checksum):
+            logger.info('Media at %s has already been posted, skipping download', img_url)
+            return DownloadedFile(path=None, checksum=known_checksum, size=0)
+
+    try:
+        with http_client.get(img_url, stream=True) as resp:
+            if resp.status_code != 200:
+                logger.error('File failed to download. Status code: %s' % resp.status_code)
+                return None
+
+            etag = resp.headers.get('ETag', '')
+            # Weak ETags only promise equivalent content, not the same bytes
+            if etag.startswith('W/'):
+                etag = ''
+            content_length = int(resp.headers.get('Content-Length', '0') or 0)
+            if post_recorder is not None:
+                known_checksum = post_recorder.known_media_checksum(media_url=img_url, etag=etag,
+                                                                    size=content_length)
+                if known_checksum is not None and post_recorder.duplicate_check(known_checksum):
+                    logger.info('Media at %s has already been posted, skipping download', img_url)
+                    return DownloadedFile(path=None, checksum=known_checksum, size=content_length)
+
+            max_sizes = max_sizes or {}
+            content_type = resp.headers.get('content-type', '').split(';')[0].strip().lower()
+            if accepted_types is not None and content_type not in accepted_types:
+                logger.error('URL does not point to a valid media file: %s (%s)',
+                             img_url, content_type)
+                return None
+            if 0 < max_sizes.get(content_type.split('/')[0], 0) < content_length:
+                logger.error('File at %s is too large: %s bytes of %s', img_url, content_length,
+                             content_type)
+                return None
+
+            # Servers don't always label media correctly, the signature decides
+            chunks = resp.iter_content(chunk_size=chunk_size)
+            first_chunk = next(chunks, b'')
+            media_type = sniff_media_type(first_chunk)
+            if media_type is None or (accepted_types is not None and
+                                      media_type not in accepted_types):
+                logger.error('File at %s is not a valid media file (%s, sent as %s)',
+                             img_url, media_type, content_type)
+                return None
+            max_size = max_sizes.get(media_type.split('/')[0], 0)
+            if 0 < max_size < content_length:
+                logger.error('File at %s is too large: %s bytes of %s', img_url, content_length,
+                             media_type)
+                return None
+
+            sha256 = hashlib.sha256()
+            size = 0
+            with open(file_path, 'wb') as image_file:
+                for chunk in chain((first_chunk,), chunks):
+                    size += len(chunk)
+                    # Content-Length can be missing or wrong
+                    if 0 < max_size < size:
+                        break
+                    image_file.write(chunk)
+                    sha256.update(chunk)
+            # Return the path of the image, which is always the same since we
+            # just overwrite images
+            image_file.close()
+            if 0 < max_size < size:
+                logger.error('File at %s is larger than %s bytes allowed for %s, download '
+                             'abandoned', img_url, max_size, media_type)
+                _remove_partial_file(file_path, logger)
+                return None
+            if post_recorder is not None:
+                post_recorder.log_media(img_url, etag, content_length, sha256.hexdigest())
+            return DownloadedFile(path=file_path, checksum=sha256.hexdigest(), size=size)
+
+    except requests.RequestException as download_error:
+        logger.error('File failed to download: %s', download_error)
+        _remove_partial_file(file_path, logger)
     return None
 
 
+def _remove_partial_file(file_path: str, logger: logging.Logger) -> None:
+    """
+    Removes a file left behind by a download that has been abandoned.
+    """
+    try:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    except OSError as remove_error:
+        logger.error('Error while deleting media file: %s', remove_error)
+
+
 class RedditHelper:
     """
     RedditHelper provides methods to collect data / content from reddit to then post on
     Mastodon/Twitter
     """
 
+    MEDIA_HOSTS = ('i.redd.it', 'i.reddituploads.com', 'v.redd.it', 'imgur.com', 'gfycat.com',
+                   'giphy.com')
+    IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+    VIDEO_EXTENSIONS = ('.gifv', '.mp4', '.webm')
+
     # Check if reddit access details in 'reddit.secret' file has already been set-up and load it.
     # otherwise guide user through setting it up.
     def __init__(self, config: Configuration,
@@ -73,6 +422,7 @@ class RedditHelper:
         self.logger = config.bot.logger
         self.user_agent = user_agent
         self.reddit_config = config.reddit
+        self.media_config = config.media
         self.global_hash_tags = config.bot.hash_tags
         self.promo_every = config.promo.every
         self.promo_message = config.promo.message
@@ -103,9 +453,31 @@ class RedditHelper:
             # Read API keys from secret file
             reddit_config.read(config_file)
 
-        self.reddit_connection = praw.Reddit(user_agent=self.user_agent,
-                                             client_id=reddit_config['Reddit']['Agent'],
-                                             client_secret=reddit_config['Reddit']['ClientSecret'])
+        self.reddit_secrets = reddit_config['Reddit']
+        # PRAW is not thread safe, so every fetch takes a connection of its own from this pool and
+        # puts it back when done. Connections, and with that their access tokens, are reused by
+        # later fetches. Reddit reports the rate limit left for the client in every response, so
+        # each connection's rate limiter keeps track of the limit shared by all of them.
+        self.connection_pool: queue.Queue = queue.Queue()
+        self.connection_pool.put(self._new_connection())
+
+    def _new_connection(self) -> praw.Reddit:
+        """
+        Opens a new connection to Reddit.
+        """
+        return praw.Reddit(user_agent=self.user_agent,
+                           client_id=self.reddit_secrets['Agent'],
+                           client_secret=self.reddit_secrets['ClientSecret'])
+
+    def _get_connection(self) -> praw.Reddit:
+        """
+        Takes a connection from the pool, or opens a new one if all connections are in use.
+        Connections have to be put back into connection_pool after use.
+        """
+        try:
+            return self.connection_pool.get_nowait()
+        except queue.Empty:
+            return self._new_connection()
 
     def get_reddit_posts(self, subreddit: str, limit: int = 10) -> dict:
         """
@@ -121,7 +493,8 @@ class RedditHelper:
         """
         posts = {}
         self.logger.info('Getting posts from Subreddit: "%s"' % subreddit)
-        subreddit_info = self.reddit_connection.subreddit(subreddit)
+        reddit_connection = self._get_connection()
+        subreddit_info = reddit_connection.subreddit(subreddit)
         try:
             for submission in subreddit_info.top("day",limit=limit):
 
@@ -145,13 +518,252 @@ class RedditHelper:
                     self.logger.info('Skipping %s, it is stickied', submission.id)
                     continue
 
+                parents = self.get_crosspost_parents(submission)
+                if parents:
+                    self.logger.debug('%s is a crosspost of %s', submission.id,
+                                      [parent_id for parent_id, _parent_url in parents])
+
                 # Create dict
                 posts[submission.id] = submission
         except prawcore.exceptions.ResponseException as reddit_exception:
             self.logger.warning('Encountered and error getting reddit posts: $%', reddit_exception)
+        finally:
+            self.connection_pool.put(reddit_connection)
 
         return posts
 
+    def get_submission(self, post_id: str) -> Optional[Submission]:
+        """
+        get_submission looks up a single reddit post by its id, for posts queued by an earlier
+        run of tootbot.
+
+        Arguments:
+            post_id (string): id of reddit post to look up
+
+        Returns:
+            submission (Submission): reddit post, or None if it could not be found
+        """
+        reddit_connection = self._get_connection()
+        try:
+            submission = next(reddit_connection.info(fullnames=['t3_' + post_id]), None)
+        except prawcore.exceptions.PrawcoreException as reddit_exception:
+            self.logger.warning('Encountered an error looking up reddit post %s: %s',
+                                post_id, reddit_exception)
+            return None
+        finally:
+            self.connection_pool.put(reddit_connection)
+        if submission is None:
+            self.logger.info('Skipping %s, it could not be found on reddit', post_id)
+            return None
+
+        return submission
+
+    @staticmethod
+    def get_crosspost_parents(submission: Submission) -> List[Tuple[str, str]]:
+        """
+        get_crosspost_parents collects the ids and urls of the submissions a crosspost has been
+        crossposted from. Only attributes already returned with the listing are used, so that this
+        doesn't cause PRAW to fetch the submission again.
+
+        Arguments:
+            submission (Submission): reddit submission to check
+
+        Returns:
+            parents (List[Tuple[str, str]]): id and url of each original submission. Empty list if
+            submission is not a crosspost.
+        """
+        attributes = vars(submission)
+        parents = []
+        parent_ids = set()
+        parent_fullname = attributes.get('crosspost_parent')
+        if parent_fullname:
+            parent_ids.add(parent_fullname.split('_', 1)[-1])
+
+        for parent in attributes.get('crosspost_parent_list') or []:
+            parent_id = parent.get('id', '')
+            parent_url = parent.get('url_overridden_by_dest') or parent.get('url', '')
+            if parent_id:
+                parent_ids.discard(parent_id)
+                parents.append((parent_id, parent_url))
+
+        # crosspost_parent_list can be missing, record at least the id of the original submission
+        parents.extend((parent_id, '') for parent_id in parent_ids)
+        return parents
+
+    def get_identifiers(self, submission: Submission) -> List[str]:
+        """
+        get_identifiers returns all identifiers a submission could have been recorded under when it
+        or the submission it has been crossposted from was posted before.
+
+        Arguments:
+            submission (Submission): reddit submission collected by get_reddit_posts
+
+        Returns:
+            identifiers (List[str]): ids and urls of submission and of any crosspost parents
+        """
+        identifiers = [submission.id, submission.url]
+        for parent_id, parent_url in self.get_crosspost_parents(submission):
+            identifiers.append(parent_id)
+            if parent_url:
+                identifiers.append(parent_url)
+        return identifiers
+
+    def triage_media(self, submission: Submission) -> MediaTriage:
+        """
+        triage_media works out from the listing data alone if a submission has media that can be
+        posted, what type of media and roughly how large it is. Only attributes already returned
+        with the listing are used, so this doesn't cause PRAW to fetch the submission again.
+
+        Arguments:
+            submission (Submission): reddit submission collected by get_reddit_posts
+
+        Returns:
+            triage (MediaTriage): media expected to be downloaded for this submission
+        """
+        attributes = vars(submission)
+        url = attributes.get('url') or ''
+        url_parts = urlsplit(url)
+        host = url_parts.netloc.lower()
+        extension = os.path.splitext(url_parts.path)[1].lower()
+        post_hint = attributes.get('post_hint', '')
+
+        if attributes.get('is_self'):
+            triage = MediaTriage(None, 0, 'self post')
+        elif attributes.get('is_gallery'):
+            triage = self._triage_gallery(attributes)
+        elif 'v.redd.it' in host or post_hint == 'hosted:video':
+            reddit_video = self._find_reddit_video(attributes)
+            if reddit_video is None:
+                triage = MediaTriage(None, 0, 'Reddit API returned no media')
+            else:
+                estimated_size = self._estimate_video_size(reddit_video)
+                if reddit_video.get('dash_url') and self.media_config.max_video_size > 0:
+                    # A smaller DASH rendition is chosen while downloading if this one is too large
+                    estimated_size = min(estimated_size, self.media_config.max_video_size)
+                triage = MediaTriage('video', estimated_size)
+        elif any(media_host in host for media_host in RedditHelper.MEDIA_HOSTS) or \
+                post_hint == 'image' or extension in RedditHelper.IMAGE_EXTENSIONS + ('.gif',):
+            triage = self._triage_linked_media(attributes, host, extension)
+        elif post_hint in ('link', 'rich:video', 'self'):
+            triage = MediaTriage(None, 0, 'links to a web page')
+        else:
+            # Nothing known about the link, only downloading it will tell
+            triage = MediaTriage('', 0)
+
+        limit = self.media_config.max_video_size if triage.media_type == 'video' \
+            else self.media_config.max_image_size
+        if triage.postable and triage.estimated_size > limit > 0:
+            triage.reason = 'about %s bytes of %s, more than %s bytes allowed' % (
+                triage.estimated_size, triage.media_type, limit)
+        return triage
+
+    def _triage_gallery(self, attributes: dict) -> MediaTriage:
+        """
+        Triages the images in a gallery post from its media_metadata.
+        """
+        media_metadata = attributes.get('media_metadata') or {}
+        items = [item['media_id'] for item in
+                 (attributes.get('gallery_data') or {}).get('items', [])] or list(media_metadata)
+        media_types = []
+        estimated_size = 0
+        for media_id in items:
+            meta = media_metadata.get(media_id, {})
+            if meta.get('status', 'valid') != 'valid' or 's' not in meta:
+                continue
+            if meta.get('e') == 'AnimatedImage':
+                media_types.append('gif')
+                estimated_size = max(estimated_size,
+                                     int(meta['s'].get('x', 0) * meta['s'].get('y', 0)
+                                         * IMAGE_BYTES_PER_PIXEL))
+                continue
+            media_types.append('image')
+            # Same rendition as get_reddit_gallery will download
+            rendition = choose_rendition([image_rendition(size['x'], size['y'], size['u'])
+                                          for size in meta.get('p', []) + [meta['s']]
+                                          if 'u' in size],
+                                         self.media_config.max_image_size,
+                                         self.media_config.max_image_pixels)
+            if rendition is not None:
+                estimated_size = max(estimated_size, rendition[1])
+        if not media_types:
+            return MediaTriage(None, 0, 'gallery has no valid media')
+        # Size limits apply per file, so the largest image decides
+        return MediaTriage('gif' if 'gif' in media_types else 'image', estimated_size)
+
+    def _triage_linked_media(self, attributes: dict, host: str, extension: str) -> MediaTriage:
+        """
+        Triages a submission linking to an image host or directly to a media file.
+        """
+        preview = attributes.get('preview') or {}
+        video_preview = preview.get('reddit_video_preview')
+        imgur_mp4 = 'imgur.com' in host and extension == '.gif' and \
+            self.media_config.imgur_prefer_mp4
+        if extension in RedditHelper.VIDEO_EXTENSIONS or 'gfycat.com' in host or imgur_mp4:
+            size = self._estimate_video_size(video_preview) if video_preview else 0
+            return MediaTriage('video', size)
+        if extension == '.gif' or 'giphy.com' in host:
+            size = self._estimate_video_size(video_preview) if video_preview else 0
+            return MediaTriage('gif', size)
+
+        estimated_size = 0
+        for image in preview.get('images', []):
+            renditions = [image_rendition(size.get('width', 0), size.get('height', 0),
+                                          size.get('url', ''))
+                          for size in [image.get('source', {})] + image.get('resolutions', [])]
+            if 'i.redd.it' not in host:
+                # Only reddit hosted images are downloaded in a smaller rendition if needed
+                renditions = renditions[:1]
+            rendition = choose_rendition(renditions, self.media_config.max_image_size,
+                                         self.media_config.max_image_pixels)
+            estimated_size = max(estimated_size, rendition[1])
+        return MediaTriage('image', estimated_size)
+
+    @staticmethod
+    def _find_reddit_video(attributes: dict) -> Optional[dict]:
+        """
+        Returns the reddit_video details of a submission or of the submission it was crossposted
+        from, or None if there are none.
+        """
+        candidates = [attributes] + list(attributes.get('crosspost_parent_list') or [])
+        for candidate in candidates:
+            for media_attribute in ('secure_media', 'media'):
+                media = candidate.get(media_attribute) or {}
+                if 'reddit_video' in media:
+                    return media['reddit_video']
+        return None
+
+    @staticmethod
+    def _estimate_video_size(reddit_video: dict) -> int:
+        """
+        Estimates the size in bytes of a reddit hosted video from its bitrate and duration.
+        """
+        return int(reddit_video.get('bitrate_kbps', 0) * 125 * reddit_video.get('duration', 0))
+
+    def get_all_reddit_posts(self, subreddits: List[SubredditConfig]) -> dict:
+        """
+        get_all_reddit_posts reads posts from all subreddits concurrently using up to
+        "fetch_workers" threads. Each thread reads from Reddit over a connection of its own,
+        taken from connection_pool.
+
+        Arguments:
+            subreddits (List[SubredditConfig]): subreddits to collect posts from
+
+        Returns:
+            posts (dict): of posts per subreddit. Each entry has the hash tags of the subreddit as
+            key and the dict returned by get_reddit_posts as value. Entries are in the same order
+            as subreddits.
+        """
+        with ThreadPoolExecutor(max_workers=self.reddit_config.fetch_workers) as executor:
+            futures = [(subreddit.tags, executor.submit(self.get_reddit_posts,
+                                                        subreddit.name,
+                                                        limit=self.reddit_config.post_limit))
+                       for subreddit in subreddits]
+            reddit_posts = {}
+            for tags, future in futures:
+                reddit_posts[tags] = future.result()
+
+        return reddit_posts
+
     def get_caption(self, submission: Submission, max_len: int,
                     add_hash_tags: str = None, promo_message: str = None) -> str:
         """
@@ -206,6 +818,27 @@ class LinkedMediaHelper:
                  ):
         self.logger = config.bot.logger
         self.save_dir = config.media.folder
+        self.http_client = config.network.http_client
+        self.post_recorder = config.bot.post_recorder
+        self.download_chunk_size = config.media.download_chunk_size
+        self.downloads_per_host = config.media.downloads_per_host
+        self.max_image_size = config.media.max_image_size
+        self.max_image_pixels = config.media.max_image_pixels
+        self.max_video_size = config.media.max_video_size
+        self.max_video_pixels = config.media.max_video_pixels
+        self.imgur_prefer_mp4 = config.media.imgur_prefer_mp4
+        self.max_sizes = {'image': config.media.max_image_size,
+                          'video': config.media.max_video_size}
+        self.normalize_quality = config.media.normalize_quality
+        self.normalize_executor = None
+        if config.media.normalize_images:
+            # Worker processes must not be forked from this process, it already runs threads
+            self.normalize_executor = ProcessPoolExecutor(
+                max_workers=config.media.normalize_workers,
+                mp_context=multiprocessing.get_context('forkserver'))
+        self.download_executor = ThreadPoolExecutor(max_workers=config.media.download_workers)
+        self.host_semaphores = {}
+        self.host_semaphores_lock = threading.Lock()
 
         try:
             imgur_config = self._get_imgur_secrets(imgur_secrets)
@@ -227,6 +860,160 @@ class LinkedMediaHelper:
             self.logger.error(FATAL_TOOTBOT_ERROR)
             sys.exit(1)
 
+    def _save_file(self, img_url: str, file_path: str,
+                   accepted_types: Tuple[str, ...] = None) -> Optional[DownloadedFile]:
+        """
+        _save_file downloads a file with _download_file and normalizes it with _normalize_file.
+
+        Arguments:
+            img_url (string): url of file to download
+            file_path (string): directory and filename where to save the downloaded file to
+            accepted_types (Tuple[str, ...]): [optional] mime types to accept
+
+        Returns:
+            downloaded_file (DownloadedFile): downloaded file or None if no file was downloaded
+        """
+        return self._normalize_file(self._download_file(img_url, file_path,
+                                                        accepted_types=accepted_types))
+
+    def _download_file(self, img_url: str, file_path: str,
+                       accepted_types: Tuple[str, ...] = None) -> Optional[DownloadedFile]:
+        """
+        _download_file calls save_file with the logger, HTTP client, chunk size and post recorder
+        of this helper. Media files that have already been posted are not downloaded again.
+
+        Arguments:
+            img_url (string): url of file to download
+            file_path (string): directory and filename where to save the downloaded file to
+            accepted_types (Tuple[str, ...]): [optional] mime types to accept
+
+        Returns:
+            downloaded_file (DownloadedFile): downloaded file or None if no file was downloaded
+        """
+        return save_file(img_url, file_path, self.logger, self.http_client,
+                         accepted_types=accepted_types, chunk_size=self.download_chunk_size,
+                         post_recorder=self.post_recorder, max_sizes=self.max_sizes)
+
+    def _save_file_limited(self, img_url: str, file_path: str,
+                           accepted_types: Tuple[str, ...] = None,
+                           fallback: tuple = None) -> Optional[DownloadedFile]:
+        """
+        _save_file_limited calls _download_file while making sure that no more than
+        downloads_per_host files are downloaded from the same host at the same time. The
+        downloaded file is normalized after the download slot has been released, so files
+        downloaded by _save_files are normalized while the other files are still downloading.
+
+        Arguments:
+            img_url (string): url of file to download
+            file_path (string): directory and filename where to save the downloaded file to
+            accepted_types (Tuple[str, ...]): [optional] mime types to accept
+            fallback (tuple): [optional] url, file path and mime types to accept of a download to
+                try instead if this download fails
+
+        Returns:
+            downloaded_file (DownloadedFile): downloaded file or None if no file was downloaded
+        """
+        host = urlsplit(img_url).netloc
+        with self.host_semaphores_lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.downloads_per_host)
+            host_semaphore = self.host_semaphores[host]
+
+        with host_semaphore:
+            downloaded_file = self._download_file(img_url, file_path,
+                                                  accepted_types=accepted_types)
+        if downloaded_file is None and fallback is not None:
+            self.logger.info('Downloading %s instead of %s', fallback[0], img_url)
+            return self._save_file_limited(*fallback)
+        return self._normalize_file(downloaded_file)
+
+    def _save_files(self, downloads: List[tuple], max_files: int) -> List[DownloadedFile]:
+        """
+        _save_files downloads files concurrently until max_files files have been downloaded.
+        Only as many downloads as are still needed are started at any time. Further downloads
+        are only started to replace downloads that failed.
+
+        Arguments:
+            downloads (List[tuple]): url, file path and optionally the mime types to accept and a
+                fallback download for each file to download in the order of preference
+            max_files (int): maximum number of files to download
+
+        Returns:
+            downloaded_files (List[DownloadedFile]): downloaded files in the same order as
+                downloads
+        """
+        pending = iter(downloads)
+        futures = deque()
+
+        def submit_next():
+            download = next(pending, None)
+            if download is not None:
+                futures.append(self.download_executor.submit(self._save_file_limited, *download))
+
+        for _ in range(max_files):
+            submit_next()
+
+        downloaded_files = []
+        while len(futures) > 0 and len(downloaded_files) < max_files:
+            downloaded_file = futures.popleft().result()
+            if downloaded_file is not None:
+                downloaded_files.append(downloaded_file)
+            else:
+                submit_next()
+
+        # Cancel downloads no longer needed, and remove files of those already under way
+        for future in futures:
+            if not future.cancel():
+                future.add_done_callback(self._remove_leftover_file)
+
+        return downloaded_files
+
+    def _normalize_file(self,
+                        downloaded_file: Optional[DownloadedFile]) -> Optional[DownloadedFile]:
+        """
+        _normalize_file normalizes a downloaded image with normalize_image in the process pool, if
+        normalizing images is enabled. Checksum and size of the original file are kept, as those
+        are what identifies the media when it is downloaded again.
+
+        Arguments:
+            downloaded_file (DownloadedFile): downloaded file, or None if nothing was downloaded
+
+        Returns:
+            downloaded_file (DownloadedFile): downloaded file with the path of the file to upload
+        """
+        if self.normalize_executor is None or downloaded_file is None or \
+                downloaded_file.path is None:
+            return downloaded_file
+
+        file_path = downloaded_file.path
+        try:
+            normalized_path = self.normalize_executor.submit(normalize_image, file_path,
+                                                             self.max_image_pixels,
+                                                             self.max_sizes['image'],
+                                                             self.normalize_quality).result()
+        except Exception as normalize_error:  # pylint: disable=broad-except
+            # A crashed worker process must not stop the post from being made
+            self.logger.error('Error while normalizing %s: %s', file_path, normalize_error)
+            return downloaded_file
+        if normalized_path != file_path:
+            self.logger.info('Normalized %s to %s', file_path, normalized_path)
+        return replace(downloaded_file, path=normalized_path)
+
+    def _remove_leftover_file(self, future) -> None:
+        """
+        _remove_leftover_file removes a file downloaded by a download no longer needed.
+
+        Arguments:
+            future (Future): finished download started by _save_files
+        """
+        if future.exception() is not None or future.result() is None or \
+                future.result().path is None:
+            return
+        try:
+            os.remove(future.result().path)
+        except OSError as remove_error:
+            self.logger.error('Error while deleting media file: %s', remove_error)
+
     def _get_gfycat_secrets(self, gfycat_secrets: str) -> configparser.ConfigParser:
         """
         _get_gfycat_secrets checks if the Gfycat api secrets file exists.
@@ -319,7 +1106,7 @@ class LinkedMediaHelper:
 
         return imgur_config
 
-    def get_imgur_image(self, img_url: str, max_images: int = 4) -> List[str]:
+    def get_imgur_image(self, img_url: str, max_images: int = 4) -> List[DownloadedFile]:
         """
         get_imgur_image downloads images from imgur.
 
@@ -328,7 +1115,8 @@ class LinkedMediaHelper:
             max_images: maximum number of images to download and process, Defaults to 4
 
         Returns:
-            file_paths (string): path to downloaded image or None if no image was downloaded
+            downloaded_files (List[DownloadedFile]): downloaded images. If no images have been
+            downloaded, an empty list will be returned.
         """
 
         # Working demo of regex: https://regex101.com/r/G29uGl/2
@@ -345,32 +1133,38 @@ class LinkedMediaHelper:
         image_urls = self._get_image_urls(img_url, imgur_id)
 
         # Download and process individual images (up to max_images)
-        imgur_paths = []
+        downloads = []
         for image_url in image_urls:
-            # If the URL is a GIFV or MP4 link, change it to the GIF version
             file_extension = os.path.splitext(image_url)[-1].lower()
-            if file_extension == '.gifv':
+            accepted_types = None
+            fallback = None
+            file_path = self.save_dir + '/' + imgur_id + '_' + str(len(downloads))
+            if self.imgur_prefer_mp4 and file_extension in ('.gif', '.gifv', '.mp4'):
+                # Imgur serves animations as MP4 as well, usually a fraction of the size of the
+                # GIF. Thumbnails served instead are recognised by their signature. Static GIFs
+                # have no MP4 version, so those are downloaded as GIF after all.
+                base_url = image_url[:-len(file_extension)]
+                fallback = (base_url + '.gif', file_path + '.gif', ('image/gif',))
+                image_url = base_url + '.mp4'
+                file_extension = '.mp4'
+                accepted_types = ('video/mp4',)
+            # If the URL is a GIFV or MP4 link, change it to the GIF version
+            elif file_extension == '.gifv':
                 file_extension = '.gif'
                 image_url = image_url.replace('.gifv', '.gif')
             elif file_extension == '.mp4':
                 file_extension = '.gif'
                 image_url = image_url.replace('.mp4', '.gif')
+            if file_extension == '.gif':
+                # Imgur will sometimes return a single-frame thumbnail instead of a GIF, which is
+                # recognised by its signature before anything is written
+                accepted_types = ('image/gif',)
 
-            # Download the image
-            file_path = self.save_dir + '/' + imgur_id + '_' + str(
-                len(imgur_paths)) + file_extension
+            file_path += file_extension
             self.logger.info('Downloading Imgur image at URL %s to %s', image_url, file_path)
-            current_image = save_file(image_url, file_path, self.logger)
+            downloads.append((image_url, file_path, accepted_types, fallback))
 
-            # Imgur will sometimes return a single-frame thumbnail
-            # instead of a GIF, so we need to check for this
-            if file_extension != '.gif' or self._check_imgur_gif(file_path):
-                imgur_paths.append(current_image)
-
-            if len(imgur_paths) == max_images:
-                break
-
-        return imgur_paths
+        return self._save_files(downloads, max_images)
 
     def _get_image_urls(self, img_url: str, imgur_id: str) -> List[str]:
         """
@@ -396,32 +1190,7 @@ class LinkedMediaHelper:
             self.logger.error('Could not get information from imgur: %s', imgur_error)
         return image_urls
 
-    def _check_imgur_gif(self, file_path: str) -> bool:
-        """
-        _check_imgur_gif checks if a file downloaded from imgur is indeed a gif. If file is not
-        a gif, remove the file.
-
-        Arguments:
-            file_path: file name and path to downloaded image
-
-        Returns:
-             True if downloaded image is indeed a GIF, otherwise returns False
-        """
-        img = PILImage.open(file_path)
-        mime = PILImage.MIME[img.format]
-        img.close()
-
-        if mime != 'image/gif':
-            self.logger.warning('Imgur: not a GIF, not posting')
-            try:
-                os.remove(file_path)
-            except OSError as remove_error:
-                self.logger.error('Error while deleting media file: %s', remove_error)
-            return False
-
-        return True
-
-    def get_gfycat_image(self, img_url: str) -> Optional[str]:
+    def get_gfycat_image(self, img_url: str) -> Optional[DownloadedFile]:
         """
         get_gfycat_image downloads full resolution images from gfycat.
 
@@ -429,13 +1198,13 @@ class LinkedMediaHelper:
             img_url (string): url of gfycat image to download
 
         Returns:
-            file_path (string): path to downloaded image or None if no image was downloaded
+            downloaded_file (DownloadedFile): downloaded image or None if no image was downloaded
         """
         gfycat_url = ""
         file_path = self.save_dir + '/'
         try:
             gfycat_name = os.path.basename(urlsplit(img_url).path)
-            response = requests.get(img_url)
+            response = self.http_client.get(img_url)
             response.raise_for_status()
             soup = BeautifulSoup(response.text, 'lxml')
             for tag in soup.find_all("source", src=True):
@@ -455,18 +1224,36 @@ class LinkedMediaHelper:
             return None
 
         self.logger.info('Downloading Gfycat at URL %s to %s', gfycat_url, file_path)
-        return save_file(gfycat_url, file_path, self.logger)
+        return self._save_file(gfycat_url, file_path)
 
-    def get_reddit_image(self, img_url: str) -> str:
+    def get_reddit_image(self, img_url: str, preview: dict = None) -> Optional[DownloadedFile]:
         """
-        get_reddit_image downloads full resolution images from i.reddit or reddituploads.
+        get_reddit_image downloads full resolution images from i.reddit or reddituploads. If the
+        full resolution image is larger than max_image_size or max_image_pixels, the largest
+        preview resolution that fits is downloaded instead.
 
         Arguments:
             img_url (string): url of imgur image to download
+            preview (dict): [optional] preview attribute of the reddit post listing the
+                resolutions available
 
         Returns:
-            file_path (string): path to downloaded image or None if no image was downloaded
+            downloaded_file (DownloadedFile): downloaded image or None if no image was downloaded
         """
+        images = (preview or {}).get('images', [])
+        if images:
+            source = images[0].get('source', {})
+            renditions = [image_rendition(size['width'], size['height'], size['url'])
+                          for size in images[0].get('resolutions', [])]
+            renditions.append(image_rendition(source.get('width', 0), source.get('height', 0),
+                                              img_url))
+            rendition = choose_rendition(renditions, self.max_image_size, self.max_image_pixels)
+            if rendition[2] != img_url:
+                file_path = self.save_dir + '/' + rendition_file_name(rendition[2], '.jpg')
+                self.logger.info('Downloading %s pixel rendition of %s at URL %s to %s',
+                                 rendition[0], img_url, rendition[2], file_path)
+                return self._save_file(rendition[2], file_path)
+
         file_name = os.path.basename(urlsplit(img_url).path)
         file_extension = os.path.splitext(img_url)[1].lower()
         # Fix for issue with i.reddituploads.com links not having a
@@ -482,55 +1269,117 @@ class LinkedMediaHelper:
                          file_path,
                          file_extension,
                          )
-        return save_file(img_url, file_path, self.logger)
+        return self._save_file(img_url, file_path)
 
-    def get_reddit_gallery(self, reddit_post: Submission, max_images: int = 4) -> List[str]:
+    def get_reddit_gallery(self, reddit_post: Submission,
+                           max_images: int = 4) -> List[DownloadedFile]:
         """
         get_reddit_gallery downloads up to max_images images from a reddit gallery post and returns
-        a List of file_paths downloaded images
+        a List of the downloaded images
 
         Arguments:
             reddit_post (reddit_post):  reddit post / submission object
             max_images (int): [optional] maximum number of images to download. Default is 4
 
         Returns:
-            file_paths (List[str]) a list of the paths to downloadeed files. If no images have been
-            downloaded, and empty list will be returned.
+            downloaded_files (List[DownloadedFile]) a list of the downloaded files. If no images
+            have been downloaded, and empty list will be returned.
         """
-        file_paths = []
+        downloads = []
         for item in sorted(reddit_post.gallery_data['items'], key=lambda x: x['id']):
             media_id = item['media_id']
             meta = reddit_post.media_metadata[media_id]
             self.logger.debug('Media Metadata: %s', meta)
             if 'e' in meta and meta['e'] == 'Image':
+                # Source unless a preview resolution is needed to stay within the budget
                 source = meta['s']
-                save_path = self.save_dir + '/' + media_id + '.' + meta['m'].split('/')[1]
-                self.logger.info('Gallery file_path, source: %s - %s', save_path, source['u'])
-                self.logger.debug('A[%4dx%04d] %s' % (source['x'], source['y'], source['u']))
-                file_paths.append(save_file(source['u'], save_path, self.logger))
-
-                if len(file_paths) == max_images:
-                    break
-
-        return file_paths
-
-    def get_reddit_video(self, reddit_post: Submission) -> str:
+                rendition = choose_rendition([image_rendition(size['x'], size['y'], size['u'])
+                                              for size in meta.get('p', []) + [source]],
+                                             self.max_image_size, self.max_image_pixels)
+                default_extension = '.' + meta['m'].split('/')[1]
+                if rendition[2] == html.unescape(source['u']):
+                    save_path = self.save_dir + '/' + media_id + default_extension
+                else:
+                    save_path = self.save_dir + '/' + rendition_file_name(rendition[2],
+                                                                          default_extension)
+                self.logger.info('Gallery file_path, source: %s - %s', save_path, rendition[2])
+                self.logger.debug('A[%9d pixels] %s' % (rendition[0], rendition[2]))
+                downloads.append((rendition[2], save_path))
+
+        return self._save_files(downloads, max_images)
+
+    def get_reddit_video(self, reddit_post: Submission) -> Optional[DownloadedFile]:
         """
-        get_reddit_video downloads full resolution video from i.reddit or reddituploads.
+        get_reddit_video downloads full resolution video from i.reddit or reddituploads. If the
+        full resolution video is larger than max_video_size or max_video_pixels, the best DASH
+        rendition that fits is downloaded instead.
 
         Arguments:
             reddit_post (reddit_post): reddit post / submission object
 
         Returns:
-            file_path (string): path to downloaded video or None if no image was downloaded
+            downloaded_file (DownloadedFile): downloaded video or None if no video was downloaded
         """
         # Get URL for MP4 version of reddit video
-        video_url = reddit_post.media['reddit_video']['fallback_url']
+        video_url = self._choose_reddit_video_url(reddit_post.media['reddit_video'])
         file_path = self.save_dir + '/' + reddit_post.id + '.mp4'
         self.logger.info('Downloading Reddit video at URL %s to %s', video_url, file_path)
-        return save_file(video_url, file_path, self.logger)
+        return self._save_file(video_url, file_path)
 
-    def get_giphy_image(self, img_url: str) -> Optional[str]:
+    def _choose_reddit_video_url(self, reddit_video: dict) -> str:
+        """
+        _choose_reddit_video_url chooses the url of the best rendition of a reddit video within
+        max_video_size and max_video_pixels. The DASH manifest listing all renditions is only
+        read if the full resolution fallback rendition is too large.
+
+        Arguments:
+            reddit_video (dict): reddit_video details of reddit post
+
+        Returns:
+            video_url (string): url of rendition to download
+        """
+        fallback_url = reddit_video['fallback_url']
+        duration = reddit_video.get('duration', 0)
+        fallback = (reddit_video.get('width', 0) * reddit_video.get('height', 0),
+                    reddit_video.get('bitrate_kbps', 0) * 125 * duration,
+                    fallback_url)
+        dash_url = reddit_video.get('dash_url')
+        if not dash_url or rendition_fits(fallback, self.max_video_size, self.max_video_pixels):
+            return fallback_url
+
+        try:
+            response = self.http_client.get(dash_url)
+            response.raise_for_status()
+            manifest = ElementTree.fromstring(response.content)
+        except (requests.RequestException, ElementTree.ParseError) as dash_error:
+            self.logger.warning('Error reading DASH manifest %s: %s', dash_url, dash_error)
+            return fallback_url
+
+        renditions = []
+        for representation in manifest.iter():
+            # Audio representations have no height
+            if not representation.tag.endswith('Representation') or \
+                    not representation.get('height'):
+                continue
+            base_url = next((child.text for child in representation
+                             if child.tag.endswith('BaseURL') and child.text), None)
+            if base_url is None:
+                continue
+            try:
+                pixels = int(representation.get('width', 0)) * int(representation.get('height'))
+                size = int(int(representation.get('bandwidth', 0)) / 8 * duration)
+            except ValueError:
+                continue
+            renditions.append((pixels, size, urljoin(dash_url, base_url.strip())))
+
+        rendition = choose_rendition(renditions, self.max_video_size, self.max_video_pixels)
+        if rendition is None:
+            return fallback_url
+        self.logger.info('Chose %s pixel rendition of about %s bytes from %s',
+                         rendition[0], rendition[1], dash_url)
+        return rendition[2]
+
+    def get_giphy_image(self, img_url: str) -> Optional[DownloadedFile]:
         """
         get_giphy_image downloads full or low resolution image from giphy
 
@@ -538,7 +1387,7 @@ class LinkedMediaHelper:
             img_url (string): url of giphy image to download
 
         Returns:
-            file_path (string): path to downloaded image or None if no image was downloaded
+            downloaded_file (DownloadedFile): downloaded image or None if no image was downloaded
         """
         # Working demo of regex: https://regex101.com/r/o8m1kA/2
         regex = r"https?://((?:.*)giphy\.com/media/|giphy.com/gifs/|i.giphy.com/)(.*-)?(\w+)(/|\n)"
@@ -552,12 +1401,12 @@ class LinkedMediaHelper:
         # Download the MP4 version of the GIF
         giphy_url = 'https://media.giphy.com/media/' + giphy_id + '/giphy.mp4'
         file_path = self.save_dir + '/' + giphy_id + 'giphy.mp4'
-        giphy_file = save_file(giphy_url, file_path, self.logger)
+        giphy_file = self._save_file(giphy_url, file_path)
         self.logger.info('Downloading Giphy at URL %s to %s', giphy_url, file_path)
 
         return giphy_file
 
-    def get_generic_image(self, img_url: str) -> Optional[str]:
+    def get_generic_image(self, img_url: str) -> Optional[DownloadedFile]:
         """
         get_generic_image downloads image or video from a generic url to a media file.
 
@@ -565,7 +1414,7 @@ class LinkedMediaHelper:
             img_url (string): url to image or video file
 
         Returns:
-            file_path (string): path to downloaded video or None if no image was downloaded
+            downloaded_file (DownloadedFile): downloaded file or None if no file was downloaded
         """
         # First check if URL starts with http:// or https://
         regex = r"^https?://"
@@ -574,24 +1423,13 @@ class LinkedMediaHelper:
             self.logger.info('Post link is not a full link: %s', img_url)
             return None
 
-        # Check if URL is an image or MP4 file, based on the MIME type
+        # Only download if URL is an image or MP4 file, based on the MIME type and the first bytes
+        # of the file. Both are checked on the same response the file is downloaded with.
         image_formats = ('image/png', 'image/jpeg', 'image/gif', 'image/webp', 'video/mp4')
-        try:
-            img_site = urlopen(img_url)
-        except (URLError, UnicodeEncodeError) as url_error:
-            self.logger.error('Error while opening URL %s', url_error)
-            return None
-
-        meta = img_site.info()
-        if meta["content-type"] not in image_formats:
-            self.logger.error('URL does not point to a valid image file: %s', img_url)
-            return None
-
-        # URL appears to be an image, so download it
         file_name = os.path.basename(urlsplit(img_url).path)
         file_path = self.save_dir + '/' + file_name
         self.logger.info('Downloading file at URL %s to %s', img_url, file_path)
-        return save_file(img_url, file_path, self.logger)
+        return self._save_file(img_url, file_path, accepted_types=image_formats)
 
 
 class MediaAttachment:
@@ -601,23 +1439,32 @@ class MediaAttachment:
     """
 
     def __init__(self, reddit_post: Submission, image_helper: LinkedMediaHelper,
-                 logger: logging.Logger):
+                 logger: logging.Logger, download: bool = True):
 
         self.media_paths = {}
+        self.perceptual_hashes = {}
         self.reddit_post = reddit_post
         self.media_url = self.reddit_post.url
         self.image_helper = image_helper
         self.logger = logger
 
-        for media_path in self.get_media():
-            self.logger.info('Media path for checksum calculation: %s', media_path)
+        downloaded_files = [downloaded_file for downloaded_file in
+                            (self.get_media() if download else [])
+                            if downloaded_file is not None]
+
+        # Checksums have already been calculated from the original files while downloading, they
+        # are kept even if the file has been normalized since
+        for downloaded_file in downloaded_files:
+            media_path = downloaded_file.path
+            self.logger.info('Media %s downloaded with checksum %s (%s bytes)',
+                             media_path, downloaded_file.checksum, downloaded_file.size)
+            # Skipped downloads of media already posted are kept with a path of None, so they
+            # still count as attachments of this post
+            self.media_paths[downloaded_file.checksum] = media_path
             if media_path is not None:
-                sha256 = hashlib.sha256()
-                with open(media_path, "rb") as media_file:
-                    # Read and update hash string value in blocks of 4K
-                    for byte_block in iter(lambda: media_file.read(4096), b""):
-                        sha256.update(byte_block)
-                self.media_paths[sha256.hexdigest()] = media_path
+                image_hash = perceptual_hash(media_path)
+                if image_hash is not None:
+                    self.perceptual_hashes[downloaded_file.checksum] = image_hash
 
     def destroy(self):
         """
@@ -633,6 +1480,7 @@ class MediaAttachment:
             self.logger.error('Error while deleting media file: %s', delete_error)
 
         self.media_paths = {}
+        self.perceptual_hashes = {}
         self.media_url = None
 
     def destroy_one_attachment(self, checksum: str):
@@ -648,11 +1496,12 @@ class MediaAttachment:
                 os.remove(media_path)
                 self.logger.info('Deleted media file at %s', media_path)
             self.media_paths.pop(checksum)
+            self.perceptual_hashes.pop(checksum, None)
         except OSError as delete_error:
             self.logger.error('Error while deleting media file: %s', delete_error)
 
     # Function for obtaining static images and GIFs from popular image hosts
-    def get_media(self) -> List[str]:
+    def get_media(self) -> List[Optional[DownloadedFile]]:
         """
         Determines which method to call depending on which site the media_url is pointing to.
         """
@@ -661,30 +1510,31 @@ class MediaAttachment:
             self.logger.info('Media folder not found, created new folder: %s',
                              self.image_helper.save_dir)
 
-        file_paths = []
+        downloaded_files = []
 
         # Download and save the linked image
         if hasattr(self.reddit_post, "is_gallery"):
             self.logger.debug('%s is a gallery post', self.reddit_post.id)
-            file_paths.extend(self.image_helper.get_reddit_gallery(self.reddit_post))
+            downloaded_files.extend(self.image_helper.get_reddit_gallery(self.reddit_post))
         elif any(s in self.media_url for s in ('i.redd.it', 'i.reddituploads.com')):
-            file_paths.append(self.image_helper.get_reddit_image(self.media_url))
+            downloaded_files.append(self.image_helper.get_reddit_image(
+                self.media_url, vars(self.reddit_post).get('preview')))
         elif 'v.redd.it' in self.media_url and not self.reddit_post.media:
             self.logger.error('Reddit API returned no media for this URL: %s', self.media_url)
         elif 'v.redd.it' in self.media_url:
-            file_paths.append(self.image_helper.get_reddit_video(self.reddit_post))
+            downloaded_files.append(self.image_helper.get_reddit_video(self.reddit_post))
 
         elif 'imgur.com' in self.media_url:
             self.logger.info('Reddit post %s links to Imgur', self.reddit_post.id)
-            file_paths.extend(self.image_helper.get_imgur_image(self.media_url))
+            downloaded_files.extend(self.image_helper.get_imgur_image(self.media_url))
 
         elif 'gfycat.com' in self.media_url:  # Gfycat
-            file_paths.append(self.image_helper.get_gfycat_image(self.media_url))
+            downloaded_files.append(self.image_helper.get_gfycat_image(self.media_url))
 
         elif 'giphy.com' in self.media_url:  # Giphy
-            file_paths.append(self.image_helper.get_giphy_image(self.media_url))
+            downloaded_files.append(self.image_helper.get_giphy_image(self.media_url))
 
         else:
-            file_paths.append(self.image_helper.get_generic_image(self.media_url))
+            downloaded_files.append(self.image_helper.get_generic_image(self.media_url))
 
-        return file_paths
+        return downloaded_files
@@ -4,16 +4,318 @@ be published on Mastodon / Twitter
 """
 import configparser
 import csv
+import gzip
+import hashlib
+import json
 import logging
+import math
 import os
+import re
+import sqlite3
+import struct
 import sys
+import threading
 import time
 from dataclasses import dataclass
 from distutils.util import strtobool
+from itertools import zip_longest
+from typing import Dict
+from typing import Iterable
 from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from urllib.parse import parse_qsl
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
+from urllib.parse import urlunsplit
 
 import coloredlogs
 
+from network import HttpClient
+
+CACHE_DATE_FORMAT = '%d/%m/%Y %H:%M:%S'
+SECONDS_PER_DAY = 24 * 60 * 60
+# Perceptual hashes of media files are logged in the checksum column with this prefix
+PERCEPTUAL_HASH_PREFIX = 'dhash:'
+# Perceptual hashes with fewer bits set (or unset) than this describe flat or uniform images, which
+# would all look the same as each other
+PERCEPTUAL_HASH_MIN_BITS = 8
+
+TRACKING_PARAMETERS = ('fbclid', 'gclid', 'dclid', 'msclkid', 'igshid', 'mc_cid', 'mc_eid',
+                       'ref', 'ref_src', 'ref_source', 'ref_url', 'share_id', 'si', 'rdt')
+HOST_PREFIXES = ('www.', 'm.', 'old.', 'new.', 'np.')
+
+# Patterns to extract stable media ids from urls of hosts that serve the same media under
+# different urls. Matched against host + path of the url, the first group is the media id. Only
+# paths that consist of the media id (and a file extension or rendition suffix) match, so listing
+# pages like imgur.com/r/<subreddit>/<id> or imgur.com/user/<name> keep their full url.
+MEDIA_ID_PATTERNS = (
+    (re.compile(r'^(?:i\.)?imgur\.com/(?:a|gallery)/(\w+)$'), 'https://imgur.com/a/%s'),
+    (re.compile(r'^(?:i\.)?imgur\.com/(\w+)(?:\.\w+)?$'), 'https://i.imgur.com/%s'),
+    (re.compile(r'^(?:i|preview)\.redd\.it/(\w+)(?:\.\w+)?$'), 'https://i.redd.it/%s'),
+    (re.compile(r'^i\.reddituploads\.com/(\w+)$'), 'https://i.reddituploads.com/%s'),
+    (re.compile(r'^v\.redd\.it/(\w+)(?:/[\w.-]+)?$'), 'https://v.redd.it/%s'),
+    (re.compile(r'^reddit\.com/(?:r/\w+/)?comments/(\w+)(?:/|$)'),
+     'https://reddit.com/comments/%s'),
+    (re.compile(r'^redd\.it/(\w+)$'), 'https://reddit.com/comments/%s'),
+    (re.compile(r'^(?:\w+\.)?gfycat\.com/(?:gifs/detail/|ifr/)?(?!(?:ifr|gifs)$)([a-zA-Z]+)'
+                r'(?:[.-][\w.-]*)?$'), 'https://gfycat.com/%s'),
+    (re.compile(r'^(?:media\d?\.)?giphy\.com/media/(\w+)(?:/[\w.-]+)?$'),
+     'https://giphy.com/gifs/%s'),
+    (re.compile(r'^i\.giphy\.com/(\w+)(?:\.\w+)?$'), 'https://giphy.com/gifs/%s'),
+    (re.compile(r'^giphy\.com/gifs/(?:[\w-]*-)?(\w+)$'), 'https://giphy.com/gifs/%s'),
+)
+
+
+def canonical_url(url: str) -> str:
+    """
+    Converts a url into a canonical form, so that different urls pointing to the same content
+    can be recognised as duplicates. Tracking parameters, fragments and common host prefixes are
+    removed and for well known media hosts the url is reduced to the id of the media.
+    Anything that doesn't look like a url is returned unchanged.
+
+    Arguments:
+        url (string): url to convert
+
+    Returns:
+        canonical form of url
+    """
+    if not url.strip().lower().startswith(('http://', 'https://')):
+        return url
+
+    try:
+        parts = urlsplit(url.strip())
+        host = parts.hostname or ''
+        port = parts.port
+    except ValueError:
+        return url
+    for prefix in HOST_PREFIXES:
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    path = parts.path.rstrip('/')
+
+    for pattern, template in MEDIA_ID_PATTERNS:
+        match = pattern.match(host + path)
+        if match:
+            media_id = match.group(1)
+            if 'gfycat' in template:
+                media_id = media_id.lower()
+            return template % media_id
+
+    query = [(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+             if not name.lower().startswith('utm_') and name.lower() not in TRACKING_PARAMETERS]
+    netloc = host
+    if port is not None:
+        netloc += ':%d' % port
+    return urlunsplit((parts.scheme.lower(), netloc, path, urlencode(sorted(query)), ''))
+
+
+def distinctive_perceptual_hash(value: int) -> bool:
+    """
+    Checks if a perceptual hash has enough detail to tell images apart.
+
+    Arguments:
+        value (int): 64 bit perceptual hash
+
+    Returns:
+        boolean: False if the hash is of a flat or uniform image
+    """
+    bits_set = bin(value).count('1')
+    return PERCEPTUAL_HASH_MIN_BITS <= bits_set <= 64 - PERCEPTUAL_HASH_MIN_BITS
+
+
+def media_host(media_url: str) -> str:
+    """
+    Returns the host of the canonical form of a media url. ETags are only unique per host, so
+    media is looked up by ETag together with the host it was downloaded from.
+
+    Arguments:
+        media_url (string): url media file has been downloaded from
+
+    Returns:
+        host name or empty string if media_url has no host
+    """
+    try:
+        return urlsplit(canonical_url(media_url)).hostname or ''
+    except ValueError:
+        return ''
+
+
+def parse_cache_date(date: str) -> float:
+    """
+    Converts the date and time column of the cache file into seconds since the epoch.
+
+    Arguments:
+        date (string): date and time as written by PostRecorder.log_post
+
+    Returns:
+        seconds since epoch. Dates that can not be parsed are treated as being logged just now
+        so that they are not dropped from the cache.
+    """
+    try:
+        return time.mktime(time.strptime(date, CACHE_DATE_FORMAT))
+    except ValueError:
+        return time.time()
+
+
+class BloomFilter:
+    """
+    Memory compact set of strings. Checking if a value has been added can return false positives,
+    at a rate that depends on the capacity and number of values added, but never false negatives.
+    """
+
+    FILE_HEADER = struct.Struct('<4sQdQq')
+    FILE_MAGIC = b'TBBF'
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.size / self.capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value: str):
+        """
+        Generates the bit positions for value using double hashing of one blake2b digest.
+        """
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        first_hash = int.from_bytes(digest[:8], 'little')
+        second_hash = int.from_bytes(digest[8:], 'little') | 1
+        for number in range(self.hash_count):
+            yield (first_hash + number * second_hash) % self.size
+
+    def add(self, value: str) -> None:
+        """
+        Adds value to the filter.
+        """
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(value))
+
+    def false_positive_rate(self) -> float:
+        """
+        Returns the estimated rate of false positives for the number of values added so far.
+        """
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+    def save(self, file_name: str, position: int) -> None:
+        """
+        Atomically writes the filter to file_name.
+
+        Arguments:
+            file_name (string): path of file to save filter to
+            position (int): marker up to where the backing store has been added to the filter
+        """
+        with open(file_name + '.tmp', 'wb') as filter_file:
+            filter_file.write(BloomFilter.FILE_HEADER.pack(BloomFilter.FILE_MAGIC, self.capacity,
+                                                           self.error_rate, self.count, position))
+            filter_file.write(self.bits)
+        os.replace(file_name + '.tmp', file_name)
+
+    @classmethod
+    def load(cls, file_name: str) -> Tuple['BloomFilter', int]:
+        """
+        Reads a filter previously written with save.
+
+        Arguments:
+            file_name (string): path of file to load filter from
+
+        Returns:
+            Tuple of the filter and the position marker it has been saved with
+
+        Raises:
+            OSError if file can not be read and ValueError if file is not a valid filter.
+        """
+        with open(file_name, 'rb') as filter_file:
+            header = filter_file.read(BloomFilter.FILE_HEADER.size)
+            bits = filter_file.read()
+        try:
+            magic, capacity, error_rate, count, position = BloomFilter.FILE_HEADER.unpack(header)
+        except struct.error as struct_error:
+            raise ValueError('Invalid bloom filter file %s' % file_name) from struct_error
+        if magic != BloomFilter.FILE_MAGIC or not 0 < error_rate < 1:
+            raise ValueError('Invalid bloom filter file %s' % file_name)
+        bloom_filter = cls(capacity, error_rate)
+        if len(bits) != len(bloom_filter.bits):
+            raise ValueError('Invalid bloom filter file %s' % file_name)
+        bloom_filter.bits = bytearray(bits)
+        bloom_filter.count = count
+        return bloom_filter, position
+
+
+class BKTree:
+    """
+    BK-tree of 64 bit perceptual hashes. Looking for hashes within a small Hamming distance only
+    visits the few branches of the tree that can hold a match instead of comparing against every
+    hash in the tree.
+    """
+
+    def __init__(self):
+        # Each node is a tuple of (hash, {distance to hash: child node})
+        self.root = None
+        self.count = 0
+
+    @staticmethod
+    def distance(first: int, second: int) -> int:
+        """
+        Returns the Hamming distance between two hashes.
+        """
+        return bin(first ^ second).count('1')
+
+    def add(self, value: int) -> None:
+        """
+        Adds value to the tree, unless it is in the tree already.
+        """
+        if self.root is None:
+            self.root = (value, {})
+            self.count += 1
+            return
+
+        node = self.root
+        while True:
+            distance = BKTree.distance(value, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (value, {})
+                self.count += 1
+                return
+            node = child
+
+    def find(self, value: int, max_distance: int) -> Optional[Tuple[int, int]]:
+        """
+        Finds the hash closest to value.
+
+        Arguments:
+            value (int): hash to look for
+            max_distance (int): maximum Hamming distance of hashes to consider
+
+        Returns:
+            Tuple of distance and closest hash, or None if there is no hash within max_distance.
+        """
+        best = None
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node_value, children = nodes.pop()
+            distance = BKTree.distance(value, node_value)
+            if distance <= max_distance:
+                best = (distance, node_value)
+                if distance == 0:
+                    break
+                # Only look for closer matches from here on
+                max_distance = distance - 1
+            nodes.extend(child for child_distance, child in children.items()
+                         if abs(child_distance - distance) <= max_distance)
+        return best
+
 
 class PostRecorder:
     """
@@ -21,9 +323,47 @@ class PostRecorder:
     the log of published content to determine if a post would be a duplicate.
     """
 
-    def __init__(self, cache_file: str, logger: logging.Logger):
+    def __init__(self, cache_file: str, logger: logging.Logger, retention_days: int = 0):
         self.cache_file = cache_file
         self.logger = logger
+        self.retention_days = retention_days
+        self.last_compaction = 0.0
+        # Media files are downloaded on several threads at the same time
+        self.lock = threading.RLock()
+
+        # In memory index of identifiers already logged, so duplicate checks don't need to read
+        # through the whole cache file every time.
+        self.reddit_ids = set()
+        self.shared_urls = set()
+        self.check_sums = set()
+        self.perceptual_hashes = BKTree()
+
+        # Index of checksums of media files downloaded before by url and by ETag and size
+        self.media_file = os.path.splitext(self.cache_file)[0] + '-media.csv'
+        self.media_by_url = {}
+        self.media_by_etag = {}
+        if not os.path.exists(self.media_file):
+            with open(self.media_file, 'w', newline='') as new_media_file:
+                default = ['Media URL', 'ETag', 'Size', 'Media Checksum']
+                csv_writer = csv.writer(new_media_file)
+                csv_writer.writerow(default)
+            logger.info('%s file not found, created a new one', self.media_file)
+        self._load_media_index()
+
+        # Index of toots posted with the time they were created, so that expired toots can be
+        # deleted without paging through the account's statuses
+        self.toots_file = os.path.splitext(self.cache_file)[0] + '-toots.csv'
+        self.toots = {}
+        if not os.path.exists(self.toots_file):
+            self._write_toots_file()
+            logger.info('%s file not found, created a new one', self.toots_file)
+        with open(self.toots_file, 'rt', newline='') as toots_file:
+            reader = csv.reader(toots_file, delimiter=',')
+            # Skip header row
+            next(reader, None)
+            for row in reader:
+                if len(row) == 2:
+                    self.toots[row[0]] = float(row[1])
 
         # Make sure logging file and media directory exists
         if not os.path.exists(self.cache_file):
@@ -34,6 +374,79 @@ class PostRecorder:
             logger.info('%s file not found, created a new one', self.cache_file)
             new_cache_file.close()
 
+        if self.retention_days > 0:
+            self.compact()
+        else:
+            self._load_index()
+
+    def _load_index(self) -> None:
+        """
+        Reads the cache file once and loads all reddit post ids, shared urls and media checksums
+        into the in memory index used by duplicate_check.
+        """
+        with open(self.cache_file, 'rt', newline='') as cache_file:
+            reader = csv.reader(cache_file, delimiter=',')
+            # Skip header row
+            next(reader, None)
+            for row in reader:
+                self._index_row(row)
+        cache_file.close()
+        self.logger.debug('Loaded %s reddit ids, %s urls and %s checksums from %s',
+                          len(self.reddit_ids), len(self.shared_urls), len(self.check_sums),
+                          self.cache_file)
+
+    def _load_media_index(self) -> None:
+        """
+        Reads the media index file into memory.
+        """
+        with open(self.media_file, 'rt', newline='') as media_file:
+            reader = csv.reader(media_file, delimiter=',')
+            # Skip header row
+            next(reader, None)
+            for row in reader:
+                if len(row) == 4:
+                    self._index_media(row[0], row[1], int(row[2] or 0), row[3])
+        self.logger.debug('Loaded %s media urls from %s', len(self.media_by_url), self.media_file)
+
+    def _index_media(self, media_url: str, etag: str, size: int, check_sum: str) -> None:
+        """
+        Adds one media file to the in memory media index.
+        """
+        self.media_by_url[canonical_url(media_url)] = check_sum
+        if etag and size:
+            self.media_by_etag[(media_host(media_url), etag, size)] = check_sum
+
+    def _index_row(self, row: List[str]) -> None:
+        """
+        Adds identifiers contained in one row of the cache file to the in memory index.
+
+        Arguments:
+            row (List[str]): row of cache file in the format
+                [reddit_id, date, post_url, shared_url, check_sum]
+        """
+        if len(row) > 0 and row[0]:
+            self.reddit_ids.add(row[0])
+        # Compacted rows can hold several space separated urls and checksums
+        if len(row) > 3:
+            self.shared_urls.update(canonical_url(url) for url in row[3].split())
+        if len(row) > 4:
+            for check_sum in row[4].split():
+                self.check_sums.add(check_sum)
+                if check_sum.startswith(PERCEPTUAL_HASH_PREFIX):
+                    self._index_perceptual_hash(check_sum)
+
+    def _index_perceptual_hash(self, perceptual_hash: str) -> None:
+        """
+        Adds a perceptual hash logged in the checksum column to the near duplicate index.
+        """
+        try:
+            value = int(perceptual_hash[len(PERCEPTUAL_HASH_PREFIX):], 16)
+        except ValueError:
+            self.logger.warning('Ignoring invalid perceptual hash %s', perceptual_hash)
+            return
+        if distinctive_perceptual_hash(value):
+            self.perceptual_hashes.add(value)
+
     def duplicate_check(self, identifier: str) -> bool:
         """
         Checks if "identifier can be found in log file of content posted to Mastodon / Twitter
@@ -49,14 +462,646 @@ class PostRecorder:
                 False if "identifier" is not in log of content already posted to Mastodon / Twitter
                 True if "identifier" has been found in log of content.
         """
-        value = False
+        identifier = canonical_url(identifier)
+        return identifier in self.reddit_ids or \
+            identifier in self.shared_urls or \
+            identifier in self.check_sums
+
+    def duplicate_check_many(self, identifiers: Iterable[str]) -> Set[str]:
+        """
+        Checks a whole batch of identifiers against the log of content posted to Mastodon / Twitter
+        in one go.
+
+        Arguments:
+            identifiers (Iterable[str]):
+                Identifiers we want to make sure have not already been posted. Same as for
+                duplicate_check.
+
+        Returns:
+            Set of all identifiers that have been found in log of content.
+        """
+        return {identifier for identifier in identifiers if self.duplicate_check(identifier)}
+
+    def near_duplicate_check(self, perceptual_hash: str, max_distance: int) -> bool:
+        """
+        Checks if media looking the same as the media with perceptual_hash has been posted before,
+        even if it has been resized or re-encoded since.
+
+        Arguments:
+            perceptual_hash (string): perceptual hash of media file prefixed with
+                PERCEPTUAL_HASH_PREFIX
+            max_distance (int): maximum number of bits the hashes may differ in
+
+        Returns:
+            boolean: True if similar media has been posted before
+        """
+        try:
+            value = int(perceptual_hash[len(PERCEPTUAL_HASH_PREFIX):], 16)
+        except ValueError:
+            return False
+        if not distinctive_perceptual_hash(value):
+            return False
+        with self.lock:
+            match = self.perceptual_hashes.find(value, max_distance)
+        if match is not None:
+            self.logger.debug('Media with perceptual hash %s is %s bits from %s%016x',
+                              perceptual_hash, match[0], PERCEPTUAL_HASH_PREFIX, match[1])
+        return match is not None
+
+    def known_media_checksum(self, media_url: str = None, etag: str = None,
+                             size: int = None) -> Optional[str]:
+        """
+        Looks up the checksum of a media file downloaded before, either by its url or by the ETag
+        and Content-Length the host of the url returned for it.
+
+        Arguments:
+            media_url (string): url media file is downloaded from
+            etag (string): strong ETag header returned with the media file
+            size (int): Content-Length header returned with the media file
+
+        Returns:
+            Checksum of the media file or None if the media file is not known.
+        """
+        if media_url and canonical_url(media_url) in self.media_by_url:
+            return self.media_by_url[canonical_url(media_url)]
+        if media_url and etag and size:
+            return self.media_by_etag.get((media_host(media_url), etag, size))
+        return None
+
+    def log_media(self, media_url: str, etag: str, size: int, check_sum: str) -> None:
+        """
+        Records the checksum of a downloaded media file, so that the same media can be recognised
+        again before it is downloaded.
+
+        Arguments:
+            media_url (string): url media file has been downloaded from
+            etag (string): ETag header returned with the media file, or empty string
+            size (int): Content-Length header returned with the media file, or 0
+            check_sum (string): checksum of the media file
+        """
+        with self.lock:
+            with open(self.media_file, 'a', newline='') as media_file:
+                csv_writer = csv.writer(media_file, delimiter=',')
+                csv_writer.writerow([media_url, etag, size, check_sum])
+            self._index_media(media_url, etag, size, check_sum)
+
+    def _write_toots_file(self) -> None:
+        """
+        Atomically rewrites the toots file from the in memory toot index.
+        """
+        with open(self.toots_file + '.tmp', 'w', newline='') as new_toots_file:
+            csv_writer = csv.writer(new_toots_file, delimiter=',')
+            csv_writer.writerow(['Toot ID', 'Created at'])
+            csv_writer.writerows(self.toots.items())
+        os.replace(self.toots_file + '.tmp', self.toots_file)
+
+    def log_toot(self, toot_id: str, created_at: float) -> None:
+        """
+        Records a toot that has been posted, so it can be deleted once it has expired.
+
+        Arguments:
+            toot_id (string): id of toot on Mastodon
+            created_at (float): time toot has been created at in seconds since the epoch
+        """
+        with self.lock:
+            with open(self.toots_file, 'a', newline='') as toots_file:
+                csv_writer = csv.writer(toots_file, delimiter=',')
+                csv_writer.writerow([toot_id, created_at])
+            self.toots[toot_id] = created_at
+
+    def toot_logged(self, toot_id: str) -> bool:
+        """
+        Checks if a toot has been recorded with log_toot and not been forgotten since.
+        """
+        return toot_id in self.toots
+
+    def expired_toots(self, created_before: float, limit: int) -> List[str]:
+        """
+        Returns toots recorded with log_toot that have been created before created_before.
+
+        Arguments:
+            created_before (float): time in seconds since the epoch
+            limit (int): maximum number of toots to return
+
+        Returns:
+            List of up to limit toot ids, oldest first
+        """
+        with self.lock:
+            expired = sorted((created_at, toot_id) for toot_id, created_at in self.toots.items()
+                             if created_at < created_before)
+        return [toot_id for _created_at, toot_id in expired[:limit]]
+
+    def forget_toots(self, toot_ids: List[str]) -> None:
+        """
+        Removes toots that have been deleted from the toot index.
+        """
+        if not toot_ids:
+            return
+        with self.lock:
+            for toot_id in toot_ids:
+                self.toots.pop(toot_id, None)
+            self._write_toots_file()
+
+    def log_post(self, reddit_id: str, post_url: str, shared_url: str, check_sum: str):
+        """
+        Logs details about reddit posts that have been published.
+
+        Arguments:
+            reddit_id (string):
+                Id of post on reddit that was published to Mastodon / Twitter
+            post_url (string):
+                URL on Mastodon / Twitter of content that was posted
+            shared_url (string):
+                URL of media attachment that was shared on Mastodon / Twitter
+            check_sum (string):
+                Checksum of media attachment that was shared on Mastodon / Twitter. This enables
+                 checking for duplicate media even if file has been renamed.
+        """
+        with self.lock:
+            with open(self.cache_file, 'a', newline='') as cache_file:
+                date = time.strftime("%d/%m/%Y") + ' ' + time.strftime("%H:%M:%S")
+                row = [reddit_id, date, post_url, shared_url, check_sum]
+                cache_csv_writer = csv.writer(cache_file, delimiter=',')
+                cache_csv_writer.writerow(row)
+            cache_file.close()
+            self._index_row(row)
+
+    def compact_if_due(self) -> None:
+        """
+        Once a day, compacts the cache if a retention window has been configured. Otherwise only
+        media files that have not been posted are dropped from the media index.
+        """
+        if time.time() - self.last_compaction > SECONDS_PER_DAY:
+            if self.retention_days > 0:
+                self.compact()
+            else:
+                self.prune_media()
+
+    def prune_media(self) -> None:
+        """
+        Drops media files that have not been posted from the media index.
+        """
+        with self.lock:
+            self.last_compaction = time.time()
+            self._prune_media()
+
+    def _archive_file_name(self, extension: str) -> str:
+        """
+        Returns the name of a new archive file for posts removed from the cache during compaction.
+        """
+        base_name = os.path.splitext(self.cache_file)[0]
+        return base_name + '-' + time.strftime('%Y%m%d-%H%M%S') + extension
+
+    def compact(self) -> None:
+        """
+        Compacts the cache file. All rows logged for the same reddit post are merged into one row
+        only containing the identifiers needed for duplicate checks. Posts last logged before the
+        retention window are moved into a gzipped archive file next to the cache file.
+        The cache file is replaced atomically and the in memory index is rebuilt. Media files
+        that have not been posted are dropped from the media index.
+        """
+        with self.lock:
+            self._compact()
+
+    def _compact(self) -> None:
+        """
+        Does the actual work for compact while holding the lock.
+        """
+        self.last_compaction = time.time()
+        cutoff = self.last_compaction - self.retention_days * SECONDS_PER_DAY
+
+        posts = {}
         with open(self.cache_file, 'rt', newline='') as cache_file:
             reader = csv.reader(cache_file, delimiter=',')
+            header = next(reader, None)
             for row in reader:
-                if identifier in row:
-                    value = True
+                if len(row) == 0 or not row[0]:
+                    continue
+                posts.setdefault(row[0], []).append(row + [''] * (5 - len(row)))
         cache_file.close()
-        return value
+
+        kept = []
+        archived = []
+        for rows in posts.values():
+            if max(parse_cache_date(row[1]) for row in rows) < cutoff:
+                archived.extend(rows)
+            else:
+                kept.append(self._merge_rows(rows))
+
+        if len(archived) > 0:
+            archive_file_name = self._archive_file_name('.csv.gz')
+            with gzip.open(archive_file_name, 'wt', newline='') as archive_file:
+                csv_writer = csv.writer(archive_file, delimiter=',')
+                csv_writer.writerow(header)
+                csv_writer.writerows(archived)
+            self.logger.info('Archived %s rows older than %s days to %s',
+                             len(archived), self.retention_days, archive_file_name)
+
+        new_cache_file_name = self.cache_file + '.tmp'
+        with open(new_cache_file_name, 'w', newline='') as new_cache_file:
+            csv_writer = csv.writer(new_cache_file, delimiter=',')
+            csv_writer.writerow(header)
+            csv_writer.writerows(kept)
+            new_cache_file.flush()
+            os.fsync(new_cache_file.fileno())
+        os.replace(new_cache_file_name, self.cache_file)
+
+        self.reddit_ids = set()
+        self.shared_urls = set()
+        self.check_sums = set()
+        self.perceptual_hashes = BKTree()
+        for row in kept:
+            self._index_row(row)
+        self.logger.info('Compacted %s to %s posts', self.cache_file, len(kept))
+        self._prune_media()
+
+    def _prune_media(self) -> None:
+        """
+        Rewrites the media index file with only the media files that have been posted.
+        """
+        media = [(media_url, check_sum) for media_url, check_sum in self.media_by_url.items()
+                 if check_sum in self.check_sums]
+        etags = {(host, check_sum): (etag, size)
+                 for (host, etag, size), check_sum in self.media_by_etag.items()}
+        new_media_file_name = self.media_file + '.tmp'
+        with open(new_media_file_name, 'w', newline='') as new_media_file:
+            csv_writer = csv.writer(new_media_file, delimiter=',')
+            csv_writer.writerow(['Media URL', 'ETag', 'Size', 'Media Checksum'])
+            for media_url, check_sum in media:
+                etag, size = etags.get((media_host(media_url), check_sum), ('', 0))
+                csv_writer.writerow([media_url, etag, size, check_sum])
+            new_media_file.flush()
+            os.fsync(new_media_file.fileno())
+        os.replace(new_media_file_name, self.media_file)
+
+        self.media_by_url = {}
+        self.media_by_etag = {}
+        self._load_media_index()
+
+    @staticmethod
+    def _merge_rows(rows: List[List[str]]) -> List[str]:
+        """
+        Merges all rows logged for one reddit post into one row. Local file paths of uploaded
+        media are dropped as only their checksums are needed to check for duplicates.
+
+        Arguments:
+            rows (List[List[str]]): rows of cache file for the same reddit post id
+
+        Returns:
+            row (List[str]): compacted row with the latest date and post url and space separated
+                lists of shared urls and checksums.
+        """
+        date = rows[0][1]
+        post_url = ''
+        shared_urls = []
+        check_sums = []
+        for row in rows:
+            if parse_cache_date(row[1]) > parse_cache_date(date):
+                date = row[1]
+            if row[2]:
+                post_url = row[2]
+            # Rows logged for media uploads have a checksum but no post url. The shared url of
+            # these rows is the path of the local media file.
+            if row[2] or not row[4]:
+                shared_urls.extend(url for url in row[3].split() if url not in shared_urls)
+            check_sums.extend(check_sum for check_sum in row[4].split()
+                              if check_sum not in check_sums)
+        return [rows[0][0], date, post_url, ' '.join(shared_urls), ' '.join(check_sums)]
+
+
+class SqlitePostRecorder(PostRecorder):
+    """
+    Implements the same logging of published reddit posts and checking for duplicates as
+    PostRecorder, but stores the log in a SQLite database with indexed columns instead of the
+    append only csv file. This keeps duplicate checks fast even with millions of logged posts.
+    """
+
+    BLOOM_FILTER_MIN_CAPACITY = 100000
+    QUERY_BATCH_SIZE = 250
+    SCHEMA_VERSION = 1
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, database_file: str, logger: logging.Logger, import_file: str = None,
+                 retention_days: int = 0, bloom_filter_error_rate: float = 0.0):
+        self.cache_file = database_file
+        self.logger = logger
+        self.retention_days = retention_days
+        self.last_compaction = 0.0
+        self.bloom_filter_error_rate = bloom_filter_error_rate
+        self.bloom_filter = None
+        self.perceptual_hashes = BKTree()
+        # Media files are downloaded on several threads at the same time. The lock serializes
+        # all use of the connection.
+        self.lock = threading.RLock()
+
+        new_database = not os.path.exists(self.cache_file)
+        self.connection = sqlite3.connect(self.cache_file, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS posts ('
+                                    'reddit_id TEXT NOT NULL, '
+                                    'posted_at INTEGER NOT NULL, '
+                                    'post_url TEXT NOT NULL DEFAULT \'\', '
+                                    'shared_url TEXT NOT NULL DEFAULT \'\', '
+                                    'check_sum TEXT NOT NULL DEFAULT \'\')')
+            for column in ('reddit_id', 'posted_at', 'post_url', 'shared_url', 'check_sum'):
+                self.connection.execute('CREATE INDEX IF NOT EXISTS posts_%s ON posts (%s)'
+                                        % (column, column))
+            self.connection.execute('CREATE TABLE IF NOT EXISTS media ('
+                                    'media_url TEXT PRIMARY KEY, '
+                                    'etag TEXT NOT NULL DEFAULT \'\', '
+                                    'size INTEGER NOT NULL DEFAULT 0, '
+                                    'check_sum TEXT NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS media_etag ON media (etag, size)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS toots ('
+                                    'toot_id TEXT PRIMARY KEY, '
+                                    'created_at REAL NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS toots_created_at '
+                                    'ON toots (created_at)')
+
+        if new_database:
+            logger.info('%s database not found, created a new one', self.cache_file)
+            self.connection.execute('PRAGMA user_version = %d' % SqlitePostRecorder.SCHEMA_VERSION)
+            if import_file is not None and os.path.exists(import_file):
+                self.import_csv(import_file)
+        else:
+            self._upgrade_schema()
+
+        if self.retention_days > 0:
+            self.compact()
+        else:
+            self._load_perceptual_hashes()
+
+        if self.bloom_filter_error_rate > 0:
+            self._load_bloom_filter()
+
+    def _load_perceptual_hashes(self) -> None:
+        """
+        Loads all perceptual hashes logged into the in memory near duplicate index.
+        """
+        self.perceptual_hashes = BKTree()
+        # Range instead of LIKE, so the query can use the index on check_sum
+        cursor = self.connection.execute('SELECT DISTINCT check_sum FROM posts '
+                                         'WHERE check_sum >= ? AND check_sum < ?',
+                                         (PERCEPTUAL_HASH_PREFIX, PERCEPTUAL_HASH_PREFIX + '~'))
+        for (perceptual_hash,) in cursor:
+            self._index_perceptual_hash(perceptual_hash)
+        self.logger.debug('Loaded %s perceptual hashes from %s',
+                          self.perceptual_hashes.count, self.cache_file)
+
+    def _upgrade_schema(self) -> None:
+        """
+        Upgrades a database created by an earlier version of tootbot. Version 1 stores urls in
+        canonical form.
+        """
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version < 1:
+            self.logger.info('Converting urls in %s to canonical form', self.cache_file)
+            self.connection.create_function('canonical_url', 1, canonical_url)
+            with self.connection:
+                self.connection.execute('UPDATE posts SET shared_url = canonical_url(shared_url)')
+                self.connection.execute('UPDATE OR REPLACE media '
+                                        'SET media_url = canonical_url(media_url)')
+            # Saved bloom filter holds the urls as they were before
+            if os.path.exists(self.cache_file + '.bloom'):
+                os.remove(self.cache_file + '.bloom')
+        self.connection.execute('PRAGMA user_version = %d' % SqlitePostRecorder.SCHEMA_VERSION)
+
+    def _load_bloom_filter(self) -> None:
+        """
+        Loads the bloom filter saved next to the database and adds any rows logged after it has
+        been saved. If there is no usable saved filter, a new filter is built from all rows.
+        """
+        bloom_file = self.cache_file + '.bloom'
+        try:
+            self.bloom_filter, last_row_id = BloomFilter.load(bloom_file)
+            if self.bloom_filter.error_rate != self.bloom_filter_error_rate:
+                raise ValueError('Bloom filter error rate has changed')
+            max_row_id = self.connection.execute('SELECT MAX(rowid) FROM posts').fetchone()[0]
+            if last_row_id > (max_row_id or 0):
+                raise ValueError('Bloom filter is newer than the database')
+            self._add_to_bloom_filter(last_row_id)
+        except (OSError, ValueError) as load_error:
+            self.logger.info('Rebuilding bloom filter because: %s', load_error)
+            self._rebuild_bloom_filter()
+
+        if self.bloom_filter.count > self.bloom_filter.capacity:
+            self._rebuild_bloom_filter()
+
+        self.logger.info('Bloom filter holds %s identifiers, estimated false positive rate: %.4f%%',
+                         self.bloom_filter.count, self.bloom_filter.false_positive_rate() * 100)
+
+    def _rebuild_bloom_filter(self) -> None:
+        """
+        Builds a new bloom filter from all rows in the database with room for twice the number
+        of identifiers currently logged.
+        """
+        number_identifiers = self.connection.execute(
+            'SELECT COUNT(*) + COUNT(NULLIF(shared_url, \'\')) + COUNT(NULLIF(check_sum, \'\')) '
+            'FROM posts').fetchone()[0]
+        self.bloom_filter = BloomFilter(max(SqlitePostRecorder.BLOOM_FILTER_MIN_CAPACITY,
+                                            2 * number_identifiers),
+                                        self.bloom_filter_error_rate)
+        self._add_to_bloom_filter(0)
+
+    def _add_to_bloom_filter(self, after_row_id: int) -> None:
+        """
+        Adds identifiers of all rows after after_row_id to the bloom filter and saves the filter.
+        """
+        last_row_id = after_row_id
+        cursor = self.connection.execute('SELECT rowid, reddit_id, shared_url, check_sum '
+                                         'FROM posts WHERE rowid > ? ORDER BY rowid',
+                                         (after_row_id,))
+        for row_id, *identifiers in cursor:
+            for identifier in identifiers:
+                if identifier:
+                    self.bloom_filter.add(identifier)
+            last_row_id = row_id
+        self.bloom_filter.save(self.cache_file + '.bloom', last_row_id)
+
+    def import_csv(self, csv_file: str) -> None:
+        """
+        Imports all rows of a cache file as written by PostRecorder into the database.
+
+        Arguments:
+            csv_file (string): path to cache file to import
+        """
+        rows = []
+        with open(csv_file, 'rt', newline='') as cache_file:
+            reader = csv.reader(cache_file, delimiter=',')
+            # Skip header row. The header only has 4 columns while the rows have 5 columns
+            next(reader, None)
+            for row in reader:
+                if len(row) == 0 or not row[0]:
+                    continue
+                row = row + [''] * (5 - len(row))
+                posted_at = int(parse_cache_date(row[1]))
+                # Rows of a compacted cache file can hold several urls and checksums
+                for shared_url, check_sum in zip_longest(row[3].split(), row[4].split(),
+                                                         fillvalue=''):
+                    rows.append((row[0], posted_at, row[2], canonical_url(shared_url), check_sum))
+                if not row[3] and not row[4]:
+                    rows.append((row[0], posted_at, row[2], '', ''))
+        cache_file.close()
+
+        with self.connection:
+            self.connection.executemany('INSERT INTO posts '
+                                        '(reddit_id, posted_at, post_url, shared_url, check_sum) '
+                                        'VALUES (?, ?, ?, ?, ?)', rows)
+        self.logger.info('Imported %s rows from %s into %s', len(rows), csv_file, self.cache_file)
+
+    def duplicate_check(self, identifier: str) -> bool:
+        """
+        Checks if "identifier can be found in log file of content posted to Mastodon / Twitter
+
+        Arguments:
+            identifier (string):
+                Any identifier we want to make sure has not already been posted. This can be id of
+                reddit post, url of media attachment file to be posted, or checksum of media
+                 attachment file.
+
+        Returns:
+            boolean:
+                False if "identifier" is not in log of content already posted to Mastodon / Twitter
+                True if "identifier" has been found in log of content.
+        """
+        if not identifier:
+            return False
+        identifier = canonical_url(identifier)
+        # Identifiers not in the bloom filter have definitely not been logged
+        if self.bloom_filter is not None and identifier not in self.bloom_filter:
+            return False
+        with self.lock:
+            cursor = self.connection.execute('SELECT EXISTS (SELECT 1 FROM posts WHERE reddit_id '
+                                             '= ?1 OR shared_url = ?1 OR check_sum = ?1)',
+                                             (identifier,))
+            return bool(cursor.fetchone()[0])
+
+    def duplicate_check_many(self, identifiers: Iterable[str]) -> Set[str]:
+        """
+        Checks a whole batch of identifiers against the log of content posted to Mastodon / Twitter
+        with as few database queries as possible.
+
+        Arguments:
+            identifiers (Iterable[str]):
+                Identifiers we want to make sure have not already been posted. Same as for
+                duplicate_check.
+
+        Returns:
+            Set of all identifiers that have been found in log of content.
+        """
+        # Identifiers are looked up in canonical form but reported back as passed in
+        originals = {}
+        for identifier in identifiers:
+            if identifier:
+                originals.setdefault(canonical_url(identifier), set()).add(identifier)
+        candidates = list(originals)
+        if self.bloom_filter is not None:
+            candidates = [identifier for identifier in candidates
+                          if identifier in self.bloom_filter]
+
+        found = set()
+        # Stay well below the maximum number of parameters SQLite allows per query
+        for start in range(0, len(candidates), SqlitePostRecorder.QUERY_BATCH_SIZE):
+            batch = candidates[start:start + SqlitePostRecorder.QUERY_BATCH_SIZE]
+            placeholders = ', '.join('?' * len(batch))
+            with self.lock:
+                cursor = self.connection.execute('SELECT reddit_id, shared_url, check_sum '
+                                                 'FROM posts WHERE reddit_id IN (%s) '
+                                                 'OR shared_url IN (%s) OR check_sum IN (%s)'
+                                                 % (placeholders, placeholders, placeholders),
+                                                 batch * 3)
+                for row in cursor:
+                    found.update(row)
+        return {original for identifier in found.intersection(candidates)
+                for original in originals[identifier]}
+
+    def known_media_checksum(self, media_url: str = None, etag: str = None,
+                             size: int = None) -> Optional[str]:
+        """
+        Looks up the checksum of a media file downloaded before, either by its url or by the ETag
+        and Content-Length the host of the url returned for it.
+
+        Arguments:
+            media_url (string): url media file is downloaded from
+            etag (string): strong ETag header returned with the media file
+            size (int): Content-Length header returned with the media file
+
+        Returns:
+            Checksum of the media file or None if the media file is not known.
+        """
+        with self.lock:
+            row = None
+            if media_url:
+                row = self.connection.execute('SELECT check_sum FROM media WHERE media_url = ?',
+                                              (canonical_url(media_url),)).fetchone()
+            if row is None and media_url and etag and size:
+                host = media_host(media_url)
+                cursor = self.connection.execute('SELECT media_url, check_sum FROM media '
+                                                 'WHERE etag = ? AND size = ?', (etag, size))
+                row = next(((check_sum,) for known_url, check_sum in cursor
+                            if media_host(known_url) == host), None)
+        return row[0] if row is not None else None
+
+    def log_media(self, media_url: str, etag: str, size: int, check_sum: str) -> None:
+        """
+        Records the checksum of a downloaded media file, so that the same media can be recognised
+        again before it is downloaded.
+
+        Arguments:
+            media_url (string): url media file has been downloaded from
+            etag (string): ETag header returned with the media file, or empty string
+            size (int): Content-Length header returned with the media file, or 0
+            check_sum (string): checksum of the media file
+        """
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO media '
+                                    '(media_url, etag, size, check_sum) VALUES (?, ?, ?, ?)',
+                                    (canonical_url(media_url), etag, size, check_sum))
+
+    def log_toot(self, toot_id: str, created_at: float) -> None:
+        """
+        Records a toot that has been posted, so it can be deleted once it has expired.
+
+        Arguments:
+            toot_id (string): id of toot on Mastodon
+            created_at (float): time toot has been created at in seconds since the epoch
+        """
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO toots (toot_id, created_at) '
+                                    'VALUES (?, ?)', (toot_id, created_at))
+
+    def toot_logged(self, toot_id: str) -> bool:
+        """
+        Checks if a toot has been recorded with log_toot and not been forgotten since.
+        """
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM toots WHERE toot_id = ?',
+                                           (toot_id,)).fetchone() is not None
+
+    def expired_toots(self, created_before: float, limit: int) -> List[str]:
+        """
+        Returns toots recorded with log_toot that have been created before created_before.
+
+        Arguments:
+            created_before (float): time in seconds since the epoch
+            limit (int): maximum number of toots to return
+
+        Returns:
+            List of up to limit toot ids, oldest first
+        """
+        with self.lock:
+            cursor = self.connection.execute('SELECT toot_id FROM toots WHERE created_at < ? '
+                                             'ORDER BY created_at LIMIT ?',
+                                             (created_before, limit))
+            return [toot_id for (toot_id,) in cursor]
+
+    def forget_toots(self, toot_ids: List[str]) -> None:
+        """
+        Removes toots that have been deleted from the toot index.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM toots WHERE toot_id = ?',
+                                        [(toot_id,) for toot_id in toot_ids])
 
     def log_post(self, reddit_id: str, post_url: str, shared_url: str, check_sum: str):
         """
@@ -73,11 +1118,228 @@ class PostRecorder:
                 Checksum of media attachment that was shared on Mastodon / Twitter. This enables
                  checking for duplicate media even if file has been renamed.
         """
-        with open(self.cache_file, 'a', newline='') as cache_file:
-            date = time.strftime("%d/%m/%Y") + ' ' + time.strftime("%H:%M:%S")
-            cache_csv_writer = csv.writer(cache_file, delimiter=',')
-            cache_csv_writer.writerow([reddit_id, date, post_url, shared_url, check_sum])
-        cache_file.close()
+        shared_url = canonical_url(shared_url)
+        with self.lock:
+            with self.connection:
+                self.connection.execute('INSERT INTO posts '
+                                        '(reddit_id, posted_at, post_url, shared_url, check_sum) '
+                                        'VALUES (?, ?, ?, ?, ?)',
+                                        (reddit_id, int(time.time()), post_url, shared_url,
+                                         check_sum))
+            if check_sum.startswith(PERCEPTUAL_HASH_PREFIX):
+                self._index_perceptual_hash(check_sum)
+            if self.bloom_filter is not None:
+                for identifier in (reddit_id, shared_url, check_sum):
+                    if identifier:
+                        self.bloom_filter.add(identifier)
+                if self.bloom_filter.count > self.bloom_filter.capacity:
+                    self._rebuild_bloom_filter()
+
+    def _compact(self) -> None:
+        """
+        Moves all posts last logged before the retention window into an archive database next to
+        the cache database and drops media files that have not been posted from the media index.
+        """
+        self.last_compaction = time.time()
+        cutoff = int(self.last_compaction - self.retention_days * SECONDS_PER_DAY)
+        expired = 'SELECT reddit_id FROM posts GROUP BY reddit_id HAVING MAX(posted_at) < ?'
+
+        number_expired = self.connection.execute('SELECT COUNT(*) FROM posts '
+                                                 'WHERE reddit_id IN (%s)' % expired,
+                                                 (cutoff,)).fetchone()[0]
+        if number_expired > 0:
+            self._archive_posts(expired, cutoff, number_expired)
+
+        self._prune_media()
+        self._load_perceptual_hashes()
+
+    def _prune_media(self) -> None:
+        """
+        Deletes media files that have not been posted from the media table.
+        """
+        with self.connection:
+            self.connection.execute('DELETE FROM media WHERE check_sum NOT IN '
+                                    '(SELECT check_sum FROM posts)')
+
+    def _archive_posts(self, expired: str, cutoff: int, number_expired: int) -> None:
+        """
+        Moves posts selected by the expired query into a new archive database.
+
+        Arguments:
+            expired (string): query selecting reddit ids of posts to archive
+            cutoff (int): parameter for expired query
+            number_expired (int): number of rows that will be archived
+        """
+
+        archive_file_name = self._archive_file_name('.db')
+        self.connection.execute('ATTACH DATABASE ? AS archive', (archive_file_name,))
+        try:
+            with self.connection:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS archive.posts AS '
+                                        'SELECT * FROM posts WHERE 0')
+                self.connection.execute('INSERT INTO archive.posts SELECT * FROM posts '
+                                        'WHERE reddit_id IN (%s)' % expired, (cutoff,))
+                self.connection.execute('DELETE FROM posts WHERE reddit_id IN (%s)' % expired,
+                                        (cutoff,))
+        finally:
+            self.connection.execute('DETACH DATABASE archive')
+        self.logger.info('Archived %s rows older than %s days to %s',
+                         number_expired, self.retention_days, archive_file_name)
+
+        # Bloom filters can't forget identifiers, so start over without the archived posts. A
+        # saved filter can't be caught up anymore either, as SQLite may hand out the row ids of
+        # deleted rows again.
+        if self.bloom_filter is not None:
+            self._rebuild_bloom_filter()
+        elif os.path.exists(self.cache_file + '.bloom'):
+            os.remove(self.cache_file + '.bloom')
+
+
+class CandidateQueue:
+    """
+    Persistent queue of reddit posts waiting to be tooted. Posts are queued first in, first out per
+    subreddit and are taken in turns from each subreddit, so posts read in one fetch from Reddit
+    are tooted over many cycles and every subreddit gets its share. Posts queued for longer than
+    expiry seconds are dropped.
+    """
+
+    def __init__(self, file_name: str, expiry: int, logger: logging.Logger) -> None:
+        self.file_name = file_name
+        self.expiry = expiry
+        self.logger = logger
+        # Lists of (post id, time queued) per subreddit hash tags, oldest first
+        self.queues: Dict[str, List[Tuple[str, float]]] = {}
+        # Hash tags of the subreddit the last post was taken from
+        self.last_served: Optional[str] = None
+
+        if os.path.exists(self.file_name):
+            try:
+                with open(self.file_name, 'rt') as queue_file:
+                    saved = json.load(queue_file)
+                self.queues = {tags: [(post_id, float(queued_at))
+                                      for post_id, queued_at in candidates]
+                               for tags, candidates in saved['queues'].items()}
+                self.last_served = saved.get('last_served')
+            except (OSError, ValueError, KeyError, TypeError, AttributeError) as queue_error:
+                logger.warning('Could not read %s, starting with an empty queue: %s',
+                               self.file_name, queue_error)
+                self.queues = {}
+        self.expire()
+        logger.info('Loaded %s queued posts from %s', self.count(), self.file_name)
+
+    def _save(self) -> None:
+        """
+        Atomically writes the queue to file_name.
+        """
+        with open(self.file_name + '.tmp', 'wt') as queue_file:
+            json.dump({'queues': self.queues, 'last_served': self.last_served}, queue_file)
+        os.replace(self.file_name + '.tmp', self.file_name)
+
+    def count(self) -> int:
+        """
+        Returns the number of posts queued.
+        """
+        return sum(len(candidates) for candidates in self.queues.values())
+
+    def queued_ids(self) -> Set[str]:
+        """
+        Returns the ids of all posts queued.
+        """
+        return {post_id
+                for candidates in self.queues.values()
+                for post_id, _queued_at in candidates}
+
+    def expire(self) -> None:
+        """
+        Drops posts queued for longer than expiry seconds.
+        """
+        queued_before = time.time() - self.expiry
+        queues = {}
+        for tags, candidates in self.queues.items():
+            kept = [candidate for candidate in candidates if candidate[1] >= queued_before]
+            if kept:
+                queues[tags] = kept
+        expired = self.count() - sum(len(candidates) for candidates in queues.values())
+        if expired > 0:
+            self.logger.info('Dropped %s queued posts older than %s seconds',
+                             expired, self.expiry)
+            self.queues = queues
+            self._save()
+
+    def empty_queues(self, subreddit_tags: List[str]) -> List[str]:
+        """
+        Lists the subreddits that have no posts queued.
+
+        Arguments:
+            subreddit_tags (List[string]): hash tags of subreddits to check
+
+        Returns:
+            List of the hash tags of subreddits without posts queued
+        """
+        self.expire()
+        return [tags for tags in subreddit_tags if not self.queues.get(tags)]
+
+    def add(self, tags: str, post_ids: Iterable[str]) -> None:
+        """
+        Queues posts read from a subreddit. Posts that are queued already are left in place.
+
+        Arguments:
+            tags (string): hash tags of subreddit posts were read from
+            post_ids (Iterable[string]): ids of reddit posts to queue, in order they should be
+            tooted
+        """
+        queued = self.queued_ids()
+        queued_at = time.time()
+        candidates = self.queues.setdefault(tags, [])
+        for post_id in post_ids:
+            if post_id not in queued:
+                candidates.append((post_id, queued_at))
+                queued.add(post_id)
+        if not candidates:
+            del self.queues[tags]
+        self._save()
+
+    def peek(self, subreddit_tags: List[str]) -> Optional[Tuple[str, str]]:
+        """
+        Returns the next post in the queue without taking it off the queue. Subreddits take turns
+        in the order of subreddit_tags, starting after the subreddit the last post was removed
+        from.
+
+        Arguments:
+            subreddit_tags (List[string]): hash tags of subreddits to take posts from
+
+        Returns:
+            Tuple of the hash tags of the subreddit and the id of the post, or None if no posts
+            are queued for any of the subreddits
+        """
+        self.expire()
+        start = 0
+        if self.last_served in subreddit_tags:
+            start = subreddit_tags.index(self.last_served) + 1
+        for offset in range(len(subreddit_tags)):
+            tags = subreddit_tags[(start + offset) % len(subreddit_tags)]
+            if self.queues.get(tags):
+                return tags, self.queues[tags][0][0]
+        return None
+
+    def remove(self, tags: str, post_id: str) -> None:
+        """
+        Takes a post off the queue once it has been dealt with, and makes the next subreddit take
+        its turn. Posts are only removed after being logged, so they are not lost if tootbot
+        stops while posting them.
+
+        Arguments:
+            tags (string): hash tags of subreddit the post was queued for
+            post_id (string): id of reddit post
+        """
+        candidates = [candidate for candidate in self.queues.get(tags, [])
+                      if candidate[0] != post_id]
+        if candidates:
+            self.queues[tags] = candidates
+        else:
+            self.queues.pop(tags, None)
+        self.last_served = tags
+        self._save()
 
 
 @dataclass
@@ -87,7 +1349,12 @@ class BotConfig:
     """
     cache_file: str
     post_recorder: PostRecorder
+    candidate_queue: CandidateQueue
     delay_between_posts: int
+    posts_per_window: int
+    post_window: int
+    post_burst: int
+    post_spacing: int
     run_once_only: bool
     hash_tags: List
     log_level: str
@@ -105,6 +1372,7 @@ class RedditReaderConfig:
     spoilers: bool
     self_posts: bool
     stickied_allowed: bool
+    fetch_workers: int
 
 
 @dataclass
@@ -133,6 +1401,18 @@ class MediaConfig:
     """
     folder: str
     media_only: bool
+    download_workers: int
+    downloads_per_host: int
+    download_chunk_size: int
+    perceptual_hash_distance: int
+    max_image_size: int
+    max_image_pixels: int
+    max_video_size: int
+    max_video_pixels: int
+    imgur_prefer_mp4: bool
+    normalize_images: bool
+    normalize_workers: int
+    normalize_quality: int
 
 
 @dataclass
@@ -150,6 +1430,19 @@ class MastodonConfig:
     number_of_errors: int
 
 
+@dataclass
+class NetworkConfig:
+    """
+    Dataclass holding configuration values for outbound HTTP requests and the shared HTTP client
+    """
+    connect_timeout: float
+    read_timeout: float
+    retries: int
+    retry_backoff: float
+    connections_per_host: int
+    http_client: HttpClient
+
+
 @dataclass
 class SubredditConfig:
     """
@@ -171,6 +1464,7 @@ class Configuration:
     media: MediaConfig
     mastodon_config: MastodonConfig
     reddit: RedditReaderConfig
+    network: NetworkConfig
 
     def __init__(self) -> None:
 
@@ -198,9 +1492,37 @@ class Configuration:
             # Parse list of hashtags
             hash_tags_string = config['BotSettings']['Hashtags']
             hash_tags = [x.strip() for x in hash_tags_string.split(',')]
+        cache_backend = bot_settings.get('CacheBackend', 'csv').strip().lower()
+        retention_days = int(bot_settings.get('CacheRetentionDays', '0'))
+        bloom_filter_error_rate = float(bot_settings.get('BloomFilterErrorRate', '0.001'))
+        if cache_backend == 'csv':
+            post_recorder = PostRecorder(bot_settings['CacheFile'], logger,
+                                         retention_days=retention_days)
+        elif cache_backend == 'sqlite':
+            post_recorder = SqlitePostRecorder(bot_settings.get('CacheDatabase', 'cache.db'),
+                                               logger,
+                                               import_file=bot_settings['CacheFile'],
+                                               retention_days=retention_days,
+                                               bloom_filter_error_rate=bloom_filter_error_rate)
+        else:
+            logger.error('Unknown CacheBackend "%s" in config file', cache_backend)
+            sys.exit(1)
+        candidate_queue = CandidateQueue(
+            bot_settings.get('CandidateQueueFile',
+                             os.path.splitext(bot_settings['CacheFile'])[0] + '-candidates.json'),
+            int(bot_settings.get('CandidateExpiry', '43200')),
+            logger)
+        delay_between_posts = int(bot_settings['DelayBetweenPosts'])
         self.bot = BotConfig(cache_file=bot_settings['CacheFile'],
-                             post_recorder=PostRecorder(bot_settings['CacheFile'], logger),
-                             delay_between_posts=int(bot_settings['DelayBetweenPosts']),
+                             post_recorder=post_recorder,
+                             candidate_queue=candidate_queue,
+                             delay_between_posts=delay_between_posts,
+                             posts_per_window=max(1, int(bot_settings.get('PostsPerWindow',
+                                                                          '1'))),
+                             post_window=max(1, int(bot_settings.get('PostWindow',
+                                                                     str(delay_between_posts)))),
+                             post_burst=max(1, int(bot_settings.get('PostBurst', '1'))),
+                             post_spacing=max(0, int(bot_settings.get('PostSpacing', '30'))),
                              run_once_only=strtobool(bot_settings['RunOnceOnly']),
                              hash_tags=hash_tags,
                              log_level=bot_settings['LogLevel'],
@@ -214,6 +1536,7 @@ class Configuration:
             spoilers=strtobool(bot_settings['SpoilersAllowed']),
             self_posts=strtobool(bot_settings['SelfPostsAllowed']),
             stickied_allowed=strtobool(bot_settings['StickiedPostsAllowed']),
+            fetch_workers=max(1, int(bot_settings.get('FetchWorkers', '4'))),
         )
 
         # Settings related to promotional messages
@@ -233,7 +1556,31 @@ class Configuration:
         # Settings related to media attachments
         media_settings = config['MediaSettings']
         self.media = MediaConfig(folder=media_settings['MediaFolder'],
-                                 media_only=strtobool(media_settings['MediaPostsOnly']))
+                                 media_only=strtobool(media_settings['MediaPostsOnly']),
+                                 download_workers=max(1, int(media_settings.get(
+                                     'DownloadWorkers', '8'))),
+                                 downloads_per_host=max(1, int(media_settings.get(
+                                     'DownloadsPerHost', '4'))),
+                                 download_chunk_size=max(1024, int(media_settings.get(
+                                     'DownloadChunkSize', '1048576'))),
+                                 perceptual_hash_distance=int(media_settings.get(
+                                     'PerceptualHashDistance', '6')),
+                                 max_image_size=int(media_settings.get(
+                                     'MaxImageSize', '16777216')),
+                                 max_image_pixels=int(media_settings.get(
+                                     'MaxImagePixels', '8294400')),
+                                 max_video_size=int(media_settings.get(
+                                     'MaxVideoSize', '103809024')),
+                                 max_video_pixels=int(media_settings.get(
+                                     'MaxVideoPixels', '2304000')),
+                                 imgur_prefer_mp4=strtobool(media_settings.get(
+                                     'ImgurPreferMP4', 'true')),
+                                 normalize_images=strtobool(media_settings.get(
+                                     'NormalizeImages', 'false')),
+                                 normalize_workers=max(1, int(media_settings.get(
+                                     'NormalizeWorkers', '2'))),
+                                 normalize_quality=min(95, max(50, int(media_settings.get(
+                                     'NormalizeQuality', '85')))))
 
         # Mastodon info
         mastodon_settings = config['Mastodon']
@@ -248,6 +1595,27 @@ class Configuration:
                                                   mastodon_settings['ThrottlingMaxDelay']),
                                               number_of_errors=0)
 
+        # Settings for outbound HTTP requests
+        if not config.has_section('NetworkSettings'):
+            config.add_section('NetworkSettings')
+        network_settings = config['NetworkSettings']
+        connect_timeout = float(network_settings.get('ConnectTimeout', '10'))
+        read_timeout = float(network_settings.get('ReadTimeout', '30'))
+        retries = int(network_settings.get('Retries', '3'))
+        retry_backoff = float(network_settings.get('RetryBackoff', '0.5'))
+        connections_per_host = max(1, int(network_settings.get('ConnectionsPerHost', '10')))
+        http_client = HttpClient(connect_timeout=connect_timeout,
+                                 read_timeout=read_timeout,
+                                 retries=retries,
+                                 backoff_factor=retry_backoff,
+                                 connections_per_host=connections_per_host)
+        self.network = NetworkConfig(connect_timeout=connect_timeout,
+                                     read_timeout=read_timeout,
+                                     retries=retries,
+                                     retry_backoff=retry_backoff,
+                                     connections_per_host=connections_per_host,
+                                     http_client=http_client)
+
         self.subreddits = []
         for subreddit, hashtags in config.items('Subreddits'):
             self.subreddits.append(SubredditConfig(subreddit, hashtags))
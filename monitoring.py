@@ -15,6 +15,7 @@ class HealthChecks:
         self.base_url = config.health.base_url
         self.uid = config.health.uuid
         self.logger = config.bot.logger
+        self.http_client = config.network.http_client
 
     def check(self, data: str = None, check_type: str = None) -> None:
         """
@@ -35,7 +36,7 @@ class HealthChecks:
         if check_type is not None:
             url = url + '/' + check_type
         try:
-            response = requests.put(url, data=data, timeout=3)
+            response = self.http_client.put(url, data=data, timeout=3)
             response.raise_for_status()
             if self.logger is not None:
                 check_type = 'OK' if check_type is None else check_type
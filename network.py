@@ -0,0 +1,61 @@
+"""
+This module contains the HTTP client shared by all outbound requests of tootbot, apart from those
+made through the Reddit and Mastodon API libraries.
+"""
+from typing import Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HttpClient:
+    """
+    HttpClient wraps one requests Session with a pool of keep-alive connections per host. Failed
+    connections and temporary server errors are retried with exponential back off and every
+    request has a connect and read timeout, unless the caller sets its own timeout.
+    """
+
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(self, connect_timeout: float, read_timeout: float, retries: int,
+                 backoff_factor: float, connections_per_host: int) -> None:
+        self.timeout: Tuple[float, float] = (connect_timeout, read_timeout)
+
+        retry = Retry(total=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=HttpClient.RETRY_STATUS_CODES,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_maxsize=connections_per_host, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a GET request over the shared session.
+
+        Arguments:
+            url (string): url to send the request to
+            kwargs: any other arguments accepted by requests.Session.get
+
+        Returns:
+            response (requests.Response): response received
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a PUT request over the shared session.
+
+        Arguments:
+            url (string): url to send the request to
+            kwargs: any other arguments accepted by requests.Session.put
+
+        Returns:
+            response (requests.Response): response received
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.put(url, **kwargs)
@@ -3,18 +3,34 @@ This module is a collection of classes and methods to perform the actual posting
  Mastodon / Twitter
 """
 
+import logging
 import os
+import queue
+import random
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
+from typing import Optional
 
 import arrow
 from mastodon import Mastodon
 from mastodon import MastodonError
+from mastodon import MastodonNetworkError
+from mastodon import MastodonNotFoundError
+from mastodon import MastodonRatelimitError
+from mastodon import MastodonServerError
+from praw.models import Submission
 
 from collect import LinkedMediaHelper
 from collect import MediaAttachment
+from collect import MediaTriage
 from collect import RedditHelper
 from control import Configuration
+from control import MastodonConfig
+from control import PostRecorder
+from control import SECONDS_PER_DAY
 
 
 class MastodonPublisher:
@@ -23,10 +39,14 @@ class MastodonPublisher:
     """
 
     MAX_LEN_TOOT = 500
+    MAX_ATTACHMENTS = 4
+    MEDIA_PROCESSING_TIMEOUT = 300
+    MEDIA_PROCESSING_MAX_POLL_INTERVAL = 5
 
     def __init__(self, config: Configuration, secrets_file: str = 'mastodon.secret') -> None:
         self.logger = config.bot.logger
         self.media_only = config.media.media_only
+        self.perceptual_hash_distance = config.media.perceptual_hash_distance
         self.nsfw_marked = config.reddit.nsfw_marked
         self.mastodon_config = config.mastodon_config
         self.post_recorder = config.bot.post_recorder
@@ -49,7 +69,8 @@ class MastodonPublisher:
                                     api_base_url=api_base_url,
                                     to_file=secrets_file)
                 self.mastodon = Mastodon(client_id=secrets_file,
-                                         api_base_url='https://' + self.mastodon_config.domain)
+                                         api_base_url='https://' + self.mastodon_config.domain,
+                                         ratelimit_method='throw')
                 self.mastodon.log_in(user_name, password, to_file=secrets_file)
                 # Make sure authentication is working
                 self.userinfo = self.mastodon.account_verify_credentials()
@@ -64,7 +85,10 @@ class MastodonPublisher:
                 sys.exit(1)
         else:
             try:
-                self.mastodon = Mastodon(access_token=secrets_file, api_base_url=api_base_url)
+                # Rate limits raise MastodonRatelimitError instead of blocking in the library,
+                # so MastodonThrottle and TootDeleter decide how long to hold off
+                self.mastodon = Mastodon(access_token=secrets_file, api_base_url=api_base_url,
+                                         ratelimit_method='throw')
                 # Make sure authentication is working
                 self.userinfo = self.mastodon.account_verify_credentials()
                 mastodon_username = self.userinfo['username']
@@ -76,125 +100,303 @@ class MastodonPublisher:
                 config.bot.logger.error('Tootbot cannot continue, now shutting down')
                 sys.exit(1)
 
+        # Mastodon clients do no locking, so every concurrent upload takes a client of its own
+        # from this pool and puts it back when done. TootDeleter runs on a thread of its own and
+        # has a client of its own for the same reason.
+        self.upload_clients: queue.Queue = queue.Queue()
+        self.toot_deleter = TootDeleter(self._new_client(), self.userinfo['id'],
+                                        self.post_recorder, self.logger)
+        self.throttle = MastodonThrottle(self.mastodon, self.mastodon_config, self.logger)
+        self.post_scheduler = TokenBucket(config.bot.posts_per_window, config.bot.post_window,
+                                          config.bot.post_burst)
+        self.post_spacing = config.bot.post_spacing
+        self.candidate_queue = config.bot.candidate_queue
+        self.subreddit_tags = [subreddit.tags for subreddit in config.subreddits]
+        # Submissions read from Reddit that are waiting in the candidate queue and their media
+        # triage, by post id
+        self.submissions = {}
+
     def make_post(self, posts: dict, reddit_helper: RedditHelper,
                   media_helper: LinkedMediaHelper) -> None:
         """
-        Makes a post on mastodon from a selection of reddit submissions.
+        Queues newly read reddit submissions and makes posts on mastodon from the queue, taking
+        turns between subreddits, for as long as the posting budget allows.
 
         Arguments:
             posts: A dictionary of subreddit specific hash tags and PRAW Submission objects
             reddit_helper: Helper class to work with Reddit
             media_helper: Helper class to retrieve media linked to from a reddit Submission.
         """
-        break_to_mainloop = False
-        for additional_hashtags, source_posts in posts.items():
-            if break_to_mainloop:
+        self._queue_candidates(posts, reddit_helper)
+
+        if not self.post_scheduler.available():
+            self.logger.info('Not posting, posting budget used up for another %.0f seconds',
+                             self.post_scheduler.seconds_until_available())
+            return
+
+        while True:
+            candidate = self.candidate_queue.peek(self.subreddit_tags)
+            if candidate is None:
+                self.logger.info('No more reddit posts queued')
                 break
+            additional_hashtags, post_id = candidate
 
-            for post in source_posts:
-                # Grab post details from dictionary
-                post_id = source_posts[post].id
-                shared_url = source_posts[post].url
-                if not (self.post_recorder.duplicate_check(post_id) or
-                        self.post_recorder.duplicate_check(shared_url)):
-                    self.logger.debug('Processing reddit post: %s', source_posts[post])
-
-                    attachments = MediaAttachment(source_posts[post],
-                                                  media_helper,
-                                                  self.logger
-                                                  )
-                    number_attachments = len(attachments.media_paths)
-
-                    self._remove_posted_earlier(attachments)
-
-                    if number_attachments > 0 and len(attachments.media_paths) == 0:
-                        self.logger.info(
-                            'Skipping %s because all attachments have already been posted', post_id)
-                        self.post_recorder.log_post(
-                            post_id,
-                            'Mastodon: Skipped because all images have already been posted',
-                            '',
-                            '')
-                        continue
-
-                    self.logger.debug('Media posts only: %s', self.media_only)
-                    # Make sure the post contains media,
-                    # if MEDIA_POSTS_ONLY in config is set to True
-                    if (self.media_only and len(attachments.media_paths) > 0) or \
-                            (not self.media_only):
-
-                        self.logger.debug('Going to post Toot.')
-
-                        try:
-                            promo_message = None
-                            if self.num_non_promo_posts >= self.promo.every > 0:
-                                promo_message = self.promo.message
-                                self.num_non_promo_posts = -1
-
-                            # Generate post caption
-                            caption = reddit_helper.get_caption(source_posts[post],
-                                                                MastodonPublisher.MAX_LEN_TOOT,
-                                                                add_hash_tags=additional_hashtags,
-                                                                promo_message=promo_message)
-
-                            # Upload media files if available
-                            media_ids = None
-                            if len(attachments.media_paths) > 0:
-                                self.logger.info('Posting to Mastodon with media(s): %s', caption)
-                                media_ids = self._post_attachments(attachments, post_id)
-                            else:
-                                self.logger.info('Posting to Mastodon without media: %s', caption)
-
-                            spoiler = None
-                            if source_posts[post].over_18 and self.nsfw_marked:
-                                spoiler = 'NSFW'
-
-                            toot = self.mastodon.status_post(
-                                status=caption,
-                                media_ids=media_ids,
-                                sensitive=self.mastodon_config.media_always_sensitive,
-                                spoiler_text=spoiler)
-
-                            # Log the toot
-                            self.post_recorder.log_post(post_id, toot["url"], shared_url, '')
-
-                            self.num_non_promo_posts += 1
-                            self.mastodon_config.number_of_errors = 0
-
-                        except MastodonError as mastodon_error:
-                            self.logger.error('Error while posting toot: %s', mastodon_error)
-                            # Log the post anyways so we don't get into a loop of the same error
-                            self.post_recorder.log_post(
-                                post_id,
-                                'Error while posting toot: %s' % mastodon_error,
-                                '',
-                                '')
-                            self.mastodon_config.number_of_errors += 1
-
-                    else:
-                        self.logger.warning(
-                            'Skipping %s, non-media posts disabled or media file not found',
-                            post_id)
-                        # Log the post anyways
-                        self.post_recorder.log_post(
-                            post_id,
-                            'Skipping, non-media posts disabled or media file not found',
-                            '',
-                            ''
-                        )
-
-                    # Clean up media file
-                    attachments.destroy()
+            tooted = self._post_candidate(post_id, additional_hashtags, reddit_helper,
+                                          media_helper)
+            if tooted is None:
+                # Mastodon is rate limiting or unavailable, keep the post queued for next time
+                break
+            # The post has been logged by now, or can't be posted at all
+            self.candidate_queue.remove(additional_hashtags, post_id)
+            self.submissions.pop(post_id, None)
 
+            if tooted:
+                self.post_scheduler.consume()
+                if not self._ready_for_next_post():
                     # Return control to main loop
-                    break_to_mainloop = True
                     break
 
-                self.logger.info('Skipping %s because it was already posted', post_id)
+    def _post_candidate(self, post_id: str, additional_hashtags: str,
+                        reddit_helper: RedditHelper,
+                        media_helper: LinkedMediaHelper) -> Optional[bool]:
+        """
+        Makes a post on mastodon from a reddit post taken from the candidate queue, unless it has
+        been posted in the meantime.
+
+        Arguments:
+            post_id: Id of reddit post
+            additional_hashtags: Hash tags of the subreddit the post was read from
+            reddit_helper: Helper class to work with Reddit
+            media_helper: Helper class to retrieve media linked to from a reddit Submission.
+
+        Returns:
+            True if a toot was attempted, False if the post was skipped, None if posting failed
+            with an error worth retrying later
+        """
+        if post_id in self.submissions:
+            submission, triage = self.submissions[post_id]
+        else:
+            # Posts read in an earlier run of tootbot have to be looked up again
+            submission = reddit_helper.get_submission(post_id)
+            if submission is None:
+                return False
+            triage = reddit_helper.triage_media(submission)
+
+        # Original of a crosspost might have been posted since the post was queued
+        if self.post_recorder.duplicate_check_many(reddit_helper.get_identifiers(submission)):
+            self.logger.info('Skipping %s because it was already posted', post_id)
+            return False
+
+        return self._post_submission(submission, triage, additional_hashtags, reddit_helper,
+                                     media_helper)
+
+    def _queue_candidates(self, posts: dict, reddit_helper: RedditHelper) -> None:
+        """
+        Adds the reddit submissions that have not been posted yet to the candidate queue.
+
+        Arguments:
+            posts: A dictionary of subreddit specific hash tags and PRAW Submission objects
+            reddit_helper: Helper class to work with Reddit
+        """
+        # Check which posts have already been published for all subreddits in one go, including
+        # the originals of any crossposts
+        identifiers = []
+        for source_posts in posts.values():
+            for submission in source_posts.values():
+                identifiers.extend(reddit_helper.get_identifiers(submission))
+        already_posted = self.post_recorder.duplicate_check_many(identifiers)
+
+        for additional_hashtags, source_posts in posts.items():
+            new_posts = []
+            for post_id, submission in source_posts.items():
+                if already_posted.intersection(reddit_helper.get_identifiers(submission)):
+                    self.logger.info('Skipping %s because it was already posted', post_id)
+                    continue
+
+                # Decide from the reddit listing if media is worth downloading at all
+                triage = reddit_helper.triage_media(submission)
+                self.logger.debug('Media triage for %s: %s', post_id, triage)
+                if self.media_only and not triage.postable:
+                    self.logger.info('Skipping %s without downloading, no postable media: %s',
+                                     post_id, triage.reason)
+                    self.post_recorder.log_post(
+                        post_id,
+                        'Skipping, non-media posts disabled and no postable media: %s'
+                        % triage.reason,
+                        '',
+                        '')
+                    already_posted.update(reddit_helper.get_identifiers(submission))
+                    continue
+
+                new_posts.append(post_id)
+                self.submissions[post_id] = (submission, triage)
+            self.candidate_queue.add(additional_hashtags, new_posts)
+
+        # Only keep submissions that are still queued
+        queued = self.candidate_queue.queued_ids()
+        self.submissions = {post_id: candidate
+                            for post_id, candidate in self.submissions.items()
+                            if post_id in queued}
+        self.logger.info('%s reddit posts queued', len(queued))
+
+    def _post_submission(self, submission: Submission, triage: MediaTriage,
+                         additional_hashtags: str, reddit_helper: RedditHelper,
+                         media_helper: LinkedMediaHelper) -> Optional[bool]:
+        """
+        Makes a post on mastodon from one reddit submission.
+
+        Arguments:
+            submission: PRAW Submission to post
+            triage: Media triage of the submission, made when it was queued
+            additional_hashtags: Hash tags of the subreddit the submission was read from
+            reddit_helper: Helper class to work with Reddit
+            media_helper: Helper class to retrieve media linked to from a reddit Submission.
+
+        Returns:
+            True if a toot was attempted, False if the submission was skipped, None if posting
+            failed with an error worth retrying later
+        """
+        post_id = submission.id
+        shared_url = submission.url
+        self.logger.debug('Processing reddit post: %s', submission)
+        tooted = False
+
+        attachments = MediaAttachment(submission,
+                                      media_helper,
+                                      self.logger,
+                                      download=triage.postable
+                                      )
+        number_attachments = len(attachments.media_paths)
+
+        self._remove_posted_earlier(attachments)
+
+        if number_attachments > 0 and len(attachments.media_paths) == 0:
+            self.logger.info(
+                'Skipping %s because all attachments have already been posted', post_id)
+            self.post_recorder.log_post(
+                post_id,
+                'Mastodon: Skipped because all images have already been posted',
+                '',
+                '')
+            self._log_crosspost_parents(
+                submission,
+                'Mastodon: Skipped because all images have already been posted',
+                reddit_helper)
+            return False
+
+        self.logger.debug('Media posts only: %s', self.media_only)
+        # Make sure the post contains media,
+        # if MEDIA_POSTS_ONLY in config is set to True
+        if (self.media_only and len(attachments.media_paths) > 0) or \
+                (not self.media_only):
+
+            self.logger.debug('Going to post Toot.')
+            tooted = True
+
+            try:
+                promo_message = None
+                if self.num_non_promo_posts >= self.promo.every > 0:
+                    promo_message = self.promo.message
+                    self.num_non_promo_posts = -1
+
+                # Generate post caption
+                caption = reddit_helper.get_caption(submission,
+                                                    MastodonPublisher.MAX_LEN_TOOT,
+                                                    add_hash_tags=additional_hashtags,
+                                                    promo_message=promo_message)
+
+                # Upload media files if available
+                media_ids = None
+                if len(attachments.media_paths) > 0:
+                    self.logger.info('Posting to Mastodon with media(s): %s', caption)
+                    media_ids = self._post_attachments(attachments, post_id)
+                else:
+                    self.logger.info('Posting to Mastodon without media: %s', caption)
+
+                spoiler = None
+                if submission.over_18 and self.nsfw_marked:
+                    spoiler = 'NSFW'
+
+                toot = self.mastodon.status_post(
+                    status=caption,
+                    media_ids=media_ids,
+                    sensitive=self.mastodon_config.media_always_sensitive,
+                    spoiler_text=spoiler)
+
+                # Log the toot
+                self.post_recorder.log_post(post_id, toot["url"], shared_url, '')
+                self.post_recorder.log_toot(str(toot['id']),
+                                            arrow.get(toot['created_at']).float_timestamp)
+                self._log_crosspost_parents(submission, toot["url"], reddit_helper)
+
+                self.num_non_promo_posts += 1
+                self.throttle.record_success()
+
+            except MastodonError as mastodon_error:
+                if isinstance(mastodon_error, MastodonThrottle.TRANSIENT_ERRORS):
+                    self.logger.warning('Error while posting toot, will retry %s later: %s',
+                                        post_id, mastodon_error)
+                    tooted = None
+                else:
+                    self.logger.error('Error while posting toot: %s', mastodon_error)
+                    # Log the post anyways so we don't get into a loop of the same error
+                    self.post_recorder.log_post(
+                        post_id,
+                        'Error while posting toot: %s' % mastodon_error,
+                        '',
+                        '')
+                self.throttle.record_error(mastodon_error)
+
+        else:
+            self.logger.warning(
+                'Skipping %s, non-media posts disabled or media file not found',
+                post_id)
+            # Log the post anyways
+            self.post_recorder.log_post(
+                post_id,
+                'Skipping, non-media posts disabled or media file not found',
+                '',
+                ''
+            )
+
+        # Clean up media file
+        attachments.destroy()
+        return tooted
+
+    def _ready_for_next_post(self) -> bool:
+        """
+        _ready_for_next_post paces toots posted from the candidate queue in one go. It waits
+        post_spacing seconds if the posting budget and throttle allow another toot by then.
+
+        Returns:
+            True if the next toot can be posted now, False to return to the main loop
+        """
+        wait = max(self.post_spacing, self.post_scheduler.seconds_until_available())
+        if wait > self.post_spacing or self.throttle.seconds_until_allowed() > 0:
+            return False
+        self.logger.debug('Waiting %s seconds before posting next toot', wait)
+        time.sleep(wait)
+        return self.post_scheduler.available()
+
+    def _log_crosspost_parents(self, submission: Submission, post_url: str,
+                               reddit_helper: RedditHelper) -> None:
+        """
+        _log_crosspost_parents logs the original submissions of a crosspost as well, so that other
+        crossposts of the same content are skipped before any of their media is downloaded.
+
+        Arguments:
+            submission: PRAW Submission that has been processed
+            post_url: URL on Mastodon of content that was posted or reason why it was skipped
+            reddit_helper: Helper class that collected the reddit post
+        """
+        for parent_id, parent_url in reddit_helper.get_crosspost_parents(submission):
+            self.post_recorder.log_post(parent_id, post_url, parent_url, '')
 
     def _post_attachments(self, attachments: MediaAttachment, post_id: str) -> List[dict]:
         """
-        _post_attachments post any media in attachments.media_paths list
+        _post_attachments post any media in attachments.media_paths list. Up to MAX_ATTACHMENTS
+        files are uploaded at the same time and each waits for the server to finish processing
+        it, so the slowest upload rather than the sum of all uploads determines how long it takes.
 
         Arguments:
             attachments: object with a list of paths to media to be posted on Mastodon
@@ -202,23 +404,92 @@ class MastodonPublisher:
         Returns:
             media_ids: List of dicts returned by mastodon.media_post
         """
+        uploads = list(attachments.media_paths.items())
+        if len(uploads) > MastodonPublisher.MAX_ATTACHMENTS:
+            self.logger.warning('Only posting %s of %s media files of %s',
+                                MastodonPublisher.MAX_ATTACHMENTS, len(uploads), post_id)
+            uploads = uploads[:MastodonPublisher.MAX_ATTACHMENTS]
+        if len(uploads) == 0:
+            return []
+
         media_ids = []
-        for checksum, media_path in attachments.media_paths.items():
-            self.logger.info('Media %s with checksum: %s',
-                             media_path,
-                             checksum)
-            media = self.mastodon.media_post(media_path)
-            # Log the media upload
-            self.post_recorder.log_post(post_id,
-                                        '',
-                                        media_path, checksum)
-            media_ids.append(media)
+        with ThreadPoolExecutor(max_workers=len(uploads)) as executor:
+            futures = [executor.submit(self._upload_attachment, media_path)
+                       for _checksum, media_path in uploads]
+            for (checksum, media_path), future in zip(uploads, futures):
+                media = future.result()
+                self.logger.info('Media %s with checksum: %s',
+                                 media_path,
+                                 checksum)
+                # Log the media upload
+                self.post_recorder.log_post(post_id,
+                                            '',
+                                            media_path, checksum)
+                if checksum in attachments.perceptual_hashes:
+                    self.post_recorder.log_post(post_id, '', '',
+                                                attachments.perceptual_hashes[checksum])
+                media_ids.append(media)
         return media_ids
 
+    def _upload_attachment(self, media_path: str) -> dict:
+        """
+        _upload_attachment uploads one media file and waits until the server has finished
+        processing it, e.g. transcoding a video, so it can be attached to a status.
+
+        Arguments:
+            media_path: path of media file to upload
+
+        Returns:
+            media: dict describing the processed media as returned by mastodon.media
+
+        Raises:
+            MastodonError if the upload fails or processing doesn't finish within
+            MEDIA_PROCESSING_TIMEOUT seconds.
+        """
+        try:
+            client = self.upload_clients.get_nowait()
+        except queue.Empty:
+            client = self._new_client()
+        try:
+            media = client.media_post(media_path, synchronous=False)
+            deadline = time.time() + MastodonPublisher.MEDIA_PROCESSING_TIMEOUT
+            poll_interval = 1
+            # Media still being processed has no url yet
+            while media.get('url') is None:
+                if time.time() > deadline:
+                    raise MastodonError('Media %s still processing after %s seconds' % (
+                        media_path, MastodonPublisher.MEDIA_PROCESSING_TIMEOUT))
+                self.logger.debug('Waiting %ss for media %s to be processed', poll_interval,
+                                  media_path)
+                time.sleep(poll_interval)
+                poll_interval = min(poll_interval * 2,
+                                    MastodonPublisher.MEDIA_PROCESSING_MAX_POLL_INTERVAL)
+                media = client.media(media['id'])
+            return media
+        except MastodonRatelimitError as ratelimit_error:
+            # The rate limit that was hit is the one this client has seen, not the main client's
+            ratelimit_error.ratelimit_reset = client.ratelimit_reset
+            raise
+        finally:
+            self.upload_clients.put(client)
+
+    def _new_client(self) -> Mastodon:
+        """
+        Creates another Mastodon client logged in with the same access token, for use on a thread
+        other than the one posting toots.
+
+        Returns:
+            Mastodon client that throws MastodonRatelimitError on rate limits.
+        """
+        return Mastodon(access_token=self.mastodon.access_token,
+                        api_base_url=self.mastodon.api_base_url,
+                        ratelimit_method='throw')
+
     def _remove_posted_earlier(self, attachments: MediaAttachment) -> None:
         """
         _remove_posted_earlier checks che checksum of all proposed attachments and removes any from
-        the list that have already been posted earlier.
+        the list that have already been posted earlier. Images are also removed if their
+        perceptual hash is within perceptual_hash_distance bits of an image posted earlier.
 
         Arguments:
             attachments: object with list of paths to media files proposed to be posted on Mastodon
@@ -235,46 +506,306 @@ class MastodonPublisher:
                 self.logger.info('Media with checksum %s has already been posted',
                                  checksum)
                 checksums.append(checksum)
+            # Check for resized or re-encoded copies of images posted earlier
+            elif self.perceptual_hash_distance >= 0 and \
+                    checksum in attachments.perceptual_hashes and \
+                    self.post_recorder.near_duplicate_check(attachments.perceptual_hashes[checksum],
+                                                            self.perceptual_hash_distance):
+                self.logger.info('Media with checksum %s looks the same as media posted earlier',
+                                 checksum)
+                checksums.append(checksum)
         # Remove all empty or previously posted images
         for checksum in checksums:
             attachments.destroy_one_attachment(checksum)
 
     def delete_toots(self, older_than_days: int) -> None:
         """
-        Deletes old toots that are older than "older_than_days" days old in batches of up to
-        whatever the limit is set to in the account_statuses call to mastodon. This limit should be
-        kept low enough to not trigger rate limiting by the mastodon server.
-        For example with the limit set to 10, this method will delete up to 10 old toots and then
-        return.
+        Queues toots that are older than "older_than_days" days old for deletion. The toots are
+        deleted by the background thread of TootDeleter, so this returns straight away.
 
         Arguments:
             older_than_days (int): This value is used to determine the most recent toot that will
                                     be considered for deletion.
         """
+        self.toot_deleter.queue_expired_toots(older_than_days)
+
+
+class TokenBucket:
+    """
+    Token bucket limiting the rate toots are posted at. It is refilled with rate tokens every
+    window seconds and holds at most burst tokens. Every toot posted takes one token.
+    """
+
+    def __init__(self, rate: int, window: int, burst: int) -> None:
+        self.fill_rate = rate / window
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.last_fill = time.monotonic()
+
+    def _fill(self) -> None:
+        """
+        Adds the tokens accrued since the last fill.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_fill) * self.fill_rate)
+        self.last_fill = now
+
+    def available(self) -> bool:
+        """
+        Returns True if a toot can be posted now.
+        """
+        self._fill()
+        return self.tokens >= 1
+
+    def consume(self) -> None:
+        """
+        Takes a token for a toot that has been posted.
+        """
+        self._fill()
+        self.tokens -= 1
+
+    def seconds_until_available(self) -> float:
+        """
+        Returns the number of seconds until a toot can be posted.
+        """
+        self._fill()
+        return max(0.0, (1 - self.tokens) / self.fill_rate)
+
+
+class MastodonThrottle:
+    """
+    Works out how long to hold off posting after the Mastodon API returned errors. Rate limit
+    errors wait until the rate limit resets, as reported by the X-RateLimit-Reset header. Server
+    and network errors back off exponentially with jitter, up to throttling_max_delay seconds.
+    Other errors, like a rejected media file, are specific to one post and don't hold off
+    posting at all.
+    """
+
+    BACKOFF_BASE = 30
+    TRANSIENT_ERRORS = (MastodonRatelimitError, MastodonServerError, MastodonNetworkError)
+
+    def __init__(self, mastodon: Mastodon, mastodon_config: MastodonConfig,
+                 logger: logging.Logger) -> None:
+        self.mastodon = mastodon
+        self.mastodon_config = mastodon_config
+        self.logger = logger
+        self.next_attempt = 0.0
+
+    def record_success(self) -> None:
+        """
+        Resets the back off after a toot has been posted.
+        """
+        self.mastodon_config.number_of_errors = 0
+        self.next_attempt = 0.0
+
+    def record_error(self, mastodon_error: MastodonError) -> None:
+        """
+        Works out when to try posting again after an error.
+
+        Arguments:
+            mastodon_error (MastodonError): error returned by Mastodon.py
+        """
+        if not isinstance(mastodon_error, MastodonThrottle.TRANSIENT_ERRORS):
+            self.logger.debug('Not throttling for permanent error %s', mastodon_error)
+            return
+
+        self.mastodon_config.number_of_errors += 1
+        max_delay = self.mastodon_config.throttling_max_delay
+        if isinstance(mastodon_error, MastodonRatelimitError):
+            # Errors from other clients, e.g. media uploads, carry the reset time they saw
+            reset = getattr(mastodon_error, 'ratelimit_reset', self.mastodon.ratelimit_reset)
+            delay = reset - time.time() + 1
+        else:
+            backoff = MastodonThrottle.BACKOFF_BASE * \
+                2 ** min(self.mastodon_config.number_of_errors - 1, 32)
+            delay = random.uniform(0.5, 1.0) * backoff
+        delay = min(max(delay, 1.0), max_delay)
+        self.next_attempt = time.time() + delay
+        self.logger.info('Holding off posting for %.0f seconds after error #%s',
+                         delay, self.mastodon_config.number_of_errors)
+
+    def seconds_until_allowed(self) -> float:
+        """
+        Returns how many seconds to wait before posting the next toot, 0 if posting is allowed
+        now. Also waits for the rate limit to reset if it has been used up, e.g. by deleting
+        toots.
+        """
+        now = time.time()
+        wait = self.next_attempt - now
+        if self.mastodon.ratelimit_remaining <= 1:
+            wait = max(wait, self.mastodon.ratelimit_reset - now + 1)
+        return max(0.0, min(wait, self.mastodon_config.throttling_max_delay))
+
+
+class TootDeleter:
+    """
+    Deletes expired toots on a background thread with its own queue, so that deleting toots never
+    delays posting. Deletions are paced against the rate limit the Mastodon instance reports,
+    always leaving RATE_LIMIT_RESERVE of it for posting. Backlogs are deleted back to back while
+    the rate limit allows. The Mastodon client given is used by the deleting thread only.
+    Toots are recorded with the time they were created when they are posted, so expired toots
+    are found without paging through the account's statuses. Toots posted before that record
+    existed are found by reading the oldest page of statuses of the account, until the oldest
+    toot on the account is one that has been recorded.
+    """
+
+    RATE_LIMIT_RESERVE = 0.2
+    QUEUE_BATCH_SIZE = 100
+    UNINDEXED_PAGE_SIZE = 40
+
+    def __init__(self, mastodon: Mastodon, account_id: str, post_recorder: PostRecorder,
+                 logger: logging.Logger) -> None:
+        self.mastodon = mastodon
+        self.account_id = account_id
+        self.post_recorder = post_recorder
+        self.logger = logger
+        # Toots posted before the toot index existed are looked for until there are none left
+        self.unindexed_toots_remaining = True
+        # Creation time of the oldest of those toots, while none of them have expired yet
+        self.oldest_unindexed_toot: Optional[float] = None
+
+        # Queue entries are a toot id to delete, or None to look for expired toots that are not
+        # in the toot index, together with the time before which toots have expired
+        self.queue = queue.Queue()
+        self.queued_toots = set()
+        self.queued_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name='TootDeleter', daemon=True)
+        self.thread.start()
+
+    def queue_expired_toots(self, older_than_days: int) -> None:
+        """
+        Queues toots recorded in the toot index that are older than older_than_days for deletion.
+        Toots still waiting in the queue are not queued again.
+
+        Arguments:
+            older_than_days (int): toots created more than this many days ago are deleted
+        """
+        oldest_to_keep = time.time() - older_than_days * SECONDS_PER_DAY
+        expired = self.post_recorder.expired_toots(oldest_to_keep, TootDeleter.QUEUE_BATCH_SIZE)
+        with self.queued_lock:
+            expired = [toot_id for toot_id in expired if toot_id not in self.queued_toots]
+            self.queued_toots.update(expired)
+            if self.unindexed_toots_remaining and None not in self.queued_toots:
+                expired.append(None)
+                self.queued_toots.add(None)
+        for toot_id in expired:
+            self.queue.put((toot_id, oldest_to_keep))
+        self.logger.debug('Queued %s expired toots for deletion, %s waiting', len(expired),
+                          self.queue.qsize())
+
+    def wait_until_done(self) -> None:
+        """
+        Blocks until all toots queued so far have been deleted.
+        """
+        self.queue.join()
+
+    def _run(self) -> None:
+        """
+        Deletes queued toots until the process exits.
+        """
+        deleted = []
+        while True:
+            toot_id, oldest_to_keep = self.queue.get()
+            try:
+                if toot_id is None:
+                    for unindexed_id in self._find_unindexed_expired_toots(oldest_to_keep):
+                        self._wait_for_rate_limit()
+                        if self._delete(unindexed_id):
+                            deleted.append(unindexed_id)
+                else:
+                    self._wait_for_rate_limit()
+                    if self._delete(toot_id):
+                        deleted.append(toot_id)
+            except MastodonError as mastodon_error:
+                self.logger.error('Encountered error while deleting_toots: %s ', mastodon_error)
+            except Exception as unexpected_error:  # pylint: disable=broad-except
+                # Keep the thread alive, deleting will be tried again next time
+                self.logger.error('Unexpected error while deleting toots: %s', unexpected_error)
+            finally:
+                with self.queued_lock:
+                    self.queued_toots.discard(toot_id)
+                # Update the toot index in batches while working through a backlog
+                if deleted and (self.queue.empty() or
+                                len(deleted) >= TootDeleter.QUEUE_BATCH_SIZE):
+                    self.post_recorder.forget_toots(deleted)
+                    deleted = []
+                self.queue.task_done()
+
+    def _delete(self, toot_id: str) -> bool:
+        """
+        Deletes one toot.
+
+        Returns:
+            True if toot has been deleted or was gone already, False if it should be tried again
+        """
+        self.logger.info('Deleting toot %s', toot_id)
         try:
-            toots = self.mastodon.account_statuses(self.userinfo['id'], limit=10)
-            now = arrow.get(arrow.now().format('YYYY-MM-DD HH:mm:ss'), 'YYYY-MM-DD HH:mm:ss')
-            oldest_to_keep = now.shift(days=-older_than_days)
-
-            # List of toots is paginated. This while loop finds the first "page" of toots that
-            # contains toots old enough to need deleting
-            while True:
-                if len(toots) == 0:
-                    break
-                last_toot_created_at = arrow.get(toots[-1]['created_at'])
-                if last_toot_created_at < oldest_to_keep:
-                    break
-                max_id = toots[-1]['id']
-                self.logger.debug('Last toot in list %s from %s is not older than %s',
-                                  max_id, last_toot_created_at, oldest_to_keep)
-                toots = self.mastodon.account_statuses(self.userinfo['id'], max_id=max_id,
-                                                       limit=10)
-
-            # Actually deleting toots that are older than "older_than_days"
-            for toot in toots:
-                created_at = arrow.get(toot['created_at'])
-                if created_at < oldest_to_keep:
-                    self.logger.info('Deleting toot %s from %s', toot['url'], toot['created_at'])
-                    self.mastodon.status_delete(toot['id'])
-        except MastodonError as mastodon_error:
-            self.logger.error('Encountered error while deleting_toots: %s ', mastodon_error)
+            self.mastodon.status_delete(toot_id)
+        except MastodonNotFoundError:
+            self.logger.info('Toot %s has already been deleted', toot_id)
+        except MastodonRatelimitError as ratelimit_error:
+            self.logger.warning('Rate limited while deleting toot %s: %s', toot_id,
+                                ratelimit_error)
+            self._sleep_until_reset()
+            return False
+        return True
+
+    def _wait_for_rate_limit(self) -> None:
+        """
+        Waits as long as needed to spread the rate limit left over the time until it resets,
+        keeping RATE_LIMIT_RESERVE of the limit for posting. Doesn't wait at all if the rate
+        limit left is enough for the whole backlog.
+        """
+        reserve = int(self.mastodon.ratelimit_limit * TootDeleter.RATE_LIMIT_RESERVE)
+        budget = self.mastodon.ratelimit_remaining - reserve
+        seconds_to_reset = self.mastodon.ratelimit_reset - time.time()
+        if seconds_to_reset <= 0:
+            return
+        if budget <= 0:
+            self.logger.info('Rate limit reserved for posting, waiting %.0f seconds before '
+                             'deleting more toots', seconds_to_reset)
+            self._sleep_until_reset()
+        elif budget < self.queue.qsize() + 1:
+            time.sleep(seconds_to_reset / budget)
+
+    def _sleep_until_reset(self) -> None:
+        """
+        Sleeps until the rate limit of the Mastodon instance is reset.
+        """
+        time.sleep(max(1.0, self.mastodon.ratelimit_reset - time.time() + 1))
+
+    def _find_unindexed_expired_toots(self, oldest_to_keep: float) -> List[str]:
+        """
+        Reads the oldest page of statuses of the account and returns those that have expired and
+        have not been recorded when they were posted.
+
+        Arguments:
+            oldest_to_keep (float): toots created before this time in seconds since the epoch
+                have expired
+
+        Returns:
+            List of ids of expired toots
+        """
+        if not self.unindexed_toots_remaining:
+            return []
+        if self.oldest_unindexed_toot is not None and self.oldest_unindexed_toot >= oldest_to_keep:
+            # None of them can have expired since the statuses were last read
+            return []
+
+        self._wait_for_rate_limit()
+        # min_id pages forward from the very first status of the account
+        toots = self.mastodon.account_statuses(self.account_id, min_id='0',
+                                               limit=TootDeleter.UNINDEXED_PAGE_SIZE)
+        unindexed = [toot for toot in toots
+                     if not self.post_recorder.toot_logged(str(toot['id']))]
+        if len(unindexed) == 0:
+            self.logger.debug('All toots on account are recorded, no longer looking for others')
+            self.unindexed_toots_remaining = False
+            return []
+
+        created = {str(toot['id']): arrow.get(toot['created_at']).float_timestamp
+                   for toot in unindexed}
+        expired = [toot_id for toot_id, created_at in created.items()
+                   if created_at < oldest_to_keep]
+        self.oldest_unindexed_toot = None if expired else min(created.values())
+        return expired
@@ -0,0 +1,60 @@
+"""
+Tests for BloomFilter and its use by SqlitePostRecorder in control.py
+"""
+import logging
+
+from control import BloomFilter
+from control import SqlitePostRecorder
+
+LOGGER = logging.getLogger(__name__)
+
+
+def test_added_values_are_found():
+    bloom_filter = BloomFilter(1000, 0.01)
+    values = ['post%d' % number for number in range(500)]
+    for value in values:
+        bloom_filter.add(value)
+    assert all(value in bloom_filter for value in values)
+    assert bloom_filter.count == 500
+
+
+def test_false_positive_rate_near_target():
+    bloom_filter = BloomFilter(1000, 0.01)
+    for number in range(1000):
+        bloom_filter.add('post%d' % number)
+    false_positives = sum('other%d' % number in bloom_filter for number in range(10000))
+    assert false_positives < 300
+    assert bloom_filter.false_positive_rate() < 0.02
+
+
+def test_save_and_load(tmp_path):
+    file_name = str(tmp_path / 'cache.db.bloom')
+    bloom_filter = BloomFilter(100, 0.01)
+    bloom_filter.add('abc')
+    bloom_filter.save(file_name, 42)
+
+    loaded, position = BloomFilter.load(file_name)
+    assert position == 42
+    assert 'abc' in loaded
+    assert loaded.count == 1
+    assert loaded.error_rate == 0.01
+
+
+def test_filter_rebuilt_after_startup_compaction(tmp_path):
+    database_file = str(tmp_path / 'cache.db')
+    recorder = SqlitePostRecorder(database_file, LOGGER, bloom_filter_error_rate=0.01)
+    with recorder.connection:
+        recorder.connection.executemany('INSERT INTO posts (reddit_id, posted_at) VALUES (?, 0)',
+                                        [('old1',), ('old2',), ('old3',)])
+    recorder._rebuild_bloom_filter()
+    recorder.connection.close()
+
+    # Startup compaction archives every row, so SQLite starts handing out row ids from 1 again
+    recorder = SqlitePostRecorder(database_file, LOGGER, retention_days=1,
+                                  bloom_filter_error_rate=0.01)
+    recorder.log_post('new1', '', '', '')
+    recorder.connection.close()
+
+    recorder = SqlitePostRecorder(database_file, LOGGER, bloom_filter_error_rate=0.01)
+    assert recorder.duplicate_check('new1')
+    assert not recorder.duplicate_check('old1')
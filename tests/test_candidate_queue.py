@@ -0,0 +1,80 @@
+"""
+Tests for CandidateQueue in control.py
+"""
+import logging
+import time
+
+from control import CandidateQueue
+
+LOGGER = logging.getLogger(__name__)
+TAGS = ['aww', 'pics', 'news']
+
+
+def take_all(queue):
+    taken = []
+    candidate = queue.peek(TAGS)
+    while candidate is not None:
+        taken.append(candidate)
+        queue.remove(*candidate)
+        candidate = queue.peek(TAGS)
+    return taken
+
+
+def test_subreddits_take_turns(tmp_path):
+    queue = CandidateQueue(str(tmp_path / 'candidates.json'), 3600, LOGGER)
+    queue.add('aww', ['a1', 'a2', 'a3'])
+    queue.add('pics', ['p1'])
+    queue.add('news', ['n1', 'n2'])
+
+    assert take_all(queue) == [('aww', 'a1'), ('pics', 'p1'), ('news', 'n1'), ('aww', 'a2'),
+                               ('news', 'n2'), ('aww', 'a3')]
+    assert queue.count() == 0
+
+
+def test_posts_queued_once(tmp_path):
+    queue = CandidateQueue(str(tmp_path / 'candidates.json'), 3600, LOGGER)
+    queue.add('aww', ['a1', 'x1'])
+    queue.add('pics', ['x1', 'p1'])
+    queue.add('aww', ['a1'])
+
+    assert queue.count() == 3
+    assert queue.queued_ids() == {'a1', 'x1', 'p1'}
+
+
+def test_peek_leaves_post_queued_until_removed(tmp_path):
+    file_name = str(tmp_path / 'candidates.json')
+    queue = CandidateQueue(file_name, 3600, LOGGER)
+    queue.add('aww', ['a1'])
+    assert queue.peek(TAGS) == ('aww', 'a1')
+
+    # Stopping before the post was removed keeps it queued
+    queue = CandidateQueue(file_name, 3600, LOGGER)
+    assert queue.peek(TAGS) == ('aww', 'a1')
+
+
+def test_turns_continue_after_restart(tmp_path):
+    file_name = str(tmp_path / 'candidates.json')
+    queue = CandidateQueue(file_name, 3600, LOGGER)
+    queue.add('aww', ['a1', 'a2'])
+    queue.add('pics', ['p1'])
+    queue.remove(*queue.peek(TAGS))
+
+    queue = CandidateQueue(file_name, 3600, LOGGER)
+    assert queue.peek(TAGS) == ('pics', 'p1')
+
+
+def test_expired_posts_dropped(tmp_path):
+    queue = CandidateQueue(str(tmp_path / 'candidates.json'), 60, LOGGER)
+    queue.add('aww', ['a1', 'a2'])
+    queue.queues['aww'][0] = ('a1', time.time() - 120)
+
+    assert queue.peek(TAGS) == ('aww', 'a2')
+    assert queue.empty_queues(TAGS) == ['pics', 'news']
+
+
+def test_unreadable_file_starts_empty(tmp_path):
+    file_name = tmp_path / 'candidates.json'
+    file_name.write_text('not json')
+    queue = CandidateQueue(str(file_name), 3600, LOGGER)
+    assert queue.count() == 0
+    assert queue.peek(TAGS) is None
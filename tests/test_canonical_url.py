@@ -0,0 +1,57 @@
+"""
+Tests for canonical_url in control.py
+"""
+import pytest
+
+from control import canonical_url
+
+
+@pytest.mark.parametrize('url, expected', [
+    ('https://imgur.com/abc123', 'https://i.imgur.com/abc123'),
+    ('https://i.imgur.com/abc123.jpg', 'https://i.imgur.com/abc123'),
+    ('https://imgur.com/gallery/abc123', 'https://imgur.com/a/abc123'),
+    ('https://preview.redd.it/abc.jpg?width=640&s=1', 'https://i.redd.it/abc'),
+    ('https://v.redd.it/xyz/DASH_720.mp4', 'https://v.redd.it/xyz'),
+    ('https://www.reddit.com/r/aww/comments/abc/title/', 'https://reddit.com/comments/abc'),
+    ('https://redd.it/abc', 'https://reddit.com/comments/abc'),
+    ('https://gfycat.com/ifr/SomeName', 'https://gfycat.com/somename'),
+    ('https://thumbs.gfycat.com/SomeName-size_restricted.gif', 'https://gfycat.com/somename'),
+    ('https://media2.giphy.com/media/AbC/giphy.gif', 'https://giphy.com/gifs/AbC'),
+    ('https://giphy.com/gifs/funny-cat-AbC', 'https://giphy.com/gifs/AbC'),
+])
+def test_media_ids(url, expected):
+    assert canonical_url(url) == expected
+
+
+@pytest.mark.parametrize('first, second', [
+    ('https://imgur.com/r/aww/abc123', 'https://imgur.com/r/pics/zzz999'),
+    ('https://imgur.com/t/cats/abc123', 'https://imgur.com/t/cats/zzz999'),
+    ('https://imgur.com/user/foo', 'https://imgur.com/user/bar'),
+    ('https://gfycat.com/ifr/SomeName', 'https://gfycat.com/ifr/OtherName'),
+])
+def test_unrelated_urls_stay_apart(first, second):
+    assert canonical_url(first) != canonical_url(second)
+
+
+def test_listing_pages_keep_full_path():
+    assert canonical_url('https://imgur.com/r/aww/abc123') == 'https://imgur.com/r/aww/abc123'
+    assert canonical_url('https://imgur.com/user/foo') == 'https://imgur.com/user/foo'
+
+
+def test_tracking_parameters_removed():
+    assert canonical_url('https://www.example.com/a/?utm_source=x&b=2&fbclid=y&a=1#top') == \
+        'https://example.com/a?a=1&b=2'
+
+
+def test_port_and_scheme_kept():
+    assert canonical_url('https://example.com:8443/a') == 'https://example.com:8443/a'
+    assert canonical_url('http://example.com/a') == 'http://example.com/a'
+
+
+def test_scheme_case_insensitive():
+    assert canonical_url('HTTPS://WWW.Example.com/x') == 'https://example.com/x'
+
+
+def test_non_urls_unchanged():
+    assert canonical_url('abc123') == 'abc123'
+    assert canonical_url('dhash:00ff00ff00ff00ff') == 'dhash:00ff00ff00ff00ff'
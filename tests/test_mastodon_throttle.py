@@ -0,0 +1,86 @@
+"""
+Tests for MastodonThrottle in publish.py
+"""
+import logging
+import queue
+import time
+from types import SimpleNamespace
+
+from mastodon import MastodonAPIError
+from mastodon import MastodonRatelimitError
+from mastodon import MastodonServerError
+
+from control import MastodonConfig
+from publish import MastodonPublisher
+from publish import MastodonThrottle
+
+LOGGER = logging.getLogger(__name__)
+
+
+def make_throttle(reset_in=60.0, remaining=100, max_delay=3600):
+    mastodon = SimpleNamespace(ratelimit_reset=time.time() + reset_in,
+                               ratelimit_remaining=remaining)
+    mastodon_config = MastodonConfig(domain='example.social', media_always_sensitive=False,
+                                     delete_after=0, throttling_enabled=True,
+                                     throttling_max_delay=max_delay, number_of_errors=0)
+    return MastodonThrottle(mastodon, mastodon_config, LOGGER)
+
+
+def test_allowed_initially():
+    assert make_throttle().seconds_until_allowed() == 0
+
+
+def test_permanent_error_does_not_throttle():
+    throttle = make_throttle()
+    throttle.record_error(MastodonAPIError('422 media rejected'))
+    assert throttle.seconds_until_allowed() == 0
+    assert throttle.mastodon_config.number_of_errors == 0
+
+
+def test_rate_limit_waits_for_reset():
+    throttle = make_throttle(reset_in=120)
+    throttle.record_error(MastodonRatelimitError('429'))
+    assert 115 < throttle.seconds_until_allowed() <= 121
+
+
+def test_rate_limit_of_upload_client_waits_for_its_reset():
+    throttle = make_throttle(reset_in=-10)
+    upload_client = SimpleNamespace(ratelimit_reset=time.time() + 300)
+
+    def media_post(media_path, synchronous):
+        raise MastodonRatelimitError('429')
+
+    upload_client.media_post = media_post
+    publisher = MastodonPublisher.__new__(MastodonPublisher)
+    publisher.mastodon = throttle.mastodon
+    publisher.upload_clients = queue.Queue()
+    publisher.upload_clients.put(upload_client)
+    try:
+        publisher._upload_attachment('image.jpg')
+    except MastodonRatelimitError as ratelimit_error:
+        throttle.record_error(ratelimit_error)
+    assert 295 < throttle.seconds_until_allowed() <= 301
+
+
+def test_server_errors_back_off_exponentially_up_to_max_delay():
+    throttle = make_throttle(max_delay=600)
+    delays = []
+    for _ in range(6):
+        throttle.record_error(MastodonServerError('503'))
+        delays.append(throttle.seconds_until_allowed())
+    assert MastodonThrottle.BACKOFF_BASE * 0.5 - 1 <= delays[0] <= MastodonThrottle.BACKOFF_BASE
+    assert delays[-1] <= 600
+    assert max(delays) > delays[0]
+
+
+def test_success_resets_back_off():
+    throttle = make_throttle()
+    throttle.record_error(MastodonServerError('503'))
+    throttle.record_success()
+    assert throttle.seconds_until_allowed() == 0
+    assert throttle.mastodon_config.number_of_errors == 0
+
+
+def test_used_up_rate_limit_holds_off():
+    throttle = make_throttle(reset_in=30, remaining=0)
+    assert 25 < throttle.seconds_until_allowed() <= 31
@@ -0,0 +1,49 @@
+"""
+Tests for the media index of PostRecorder and SqlitePostRecorder in control.py
+"""
+import logging
+
+import pytest
+
+from control import PostRecorder
+from control import SqlitePostRecorder
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pytest.fixture(params=['csv', 'sqlite'])
+def recorder(request, tmp_path):
+    if request.param == 'csv':
+        return PostRecorder(str(tmp_path / 'cache.csv'), LOGGER)
+    return SqlitePostRecorder(str(tmp_path / 'cache.db'), LOGGER)
+
+
+def test_known_by_url(recorder):
+    recorder.log_media('https://i.imgur.com/abc123.jpg', '"1234-abcd"', 1000, 'sum1')
+    assert recorder.known_media_checksum(media_url='https://imgur.com/abc123') == 'sum1'
+    assert recorder.known_media_checksum(media_url='https://i.imgur.com/other.jpg') is None
+
+
+def test_known_by_etag_on_same_host(recorder):
+    recorder.log_media('https://example.com/a.jpg', '"1234-abcd"', 1000, 'sum1')
+    assert recorder.known_media_checksum(media_url='https://example.com/b.jpg',
+                                         etag='"1234-abcd"', size=1000) == 'sum1'
+    assert recorder.known_media_checksum(media_url='https://example.com/b.jpg',
+                                         etag='"1234-abcd"', size=1001) is None
+
+
+def test_etag_not_shared_between_hosts(recorder):
+    recorder.log_media('https://example.com/a.jpg', '"1234-abcd"', 1000, 'sum1')
+    assert recorder.known_media_checksum(media_url='https://example.org/a.jpg',
+                                         etag='"1234-abcd"', size=1000) is None
+
+
+def test_unposted_media_pruned(recorder):
+    recorder.log_media('https://example.com/posted.jpg', '', 0, 'sum1')
+    recorder.log_media('https://example.com/skipped.jpg', '', 0, 'sum2')
+    recorder.log_post('abc', 'https://mastodon.example/@bot/1', '', 'sum1')
+
+    recorder.compact_if_due()
+
+    assert recorder.known_media_checksum(media_url='https://example.com/posted.jpg') == 'sum1'
+    assert recorder.known_media_checksum(media_url='https://example.com/skipped.jpg') is None
@@ -0,0 +1,48 @@
+"""
+Tests for BKTree and the perceptual hash index in control.py
+"""
+import logging
+
+from control import BKTree
+from control import PERCEPTUAL_HASH_PREFIX
+from control import PostRecorder
+from control import distinctive_perceptual_hash
+
+LOGGER = logging.getLogger(__name__)
+
+
+def test_distance():
+    assert BKTree.distance(0b1010, 0b0110) == 2
+    assert BKTree.distance(5, 5) == 0
+
+
+def test_find_closest_within_distance():
+    tree = BKTree()
+    for value in (0x0f0f0f0f0f0f0f0f, 0x00ff00ff00ff00ff, 0x3333333333333333):
+        tree.add(value)
+    assert tree.count == 3
+    assert tree.find(0x0f0f0f0f0f0f0f0e, 2) == (1, 0x0f0f0f0f0f0f0f0f)
+    assert tree.find(0x00ff00ff00ff00fc, 1) is None
+    assert tree.find(0x00ff00ff00ff00fc, 2) == (2, 0x00ff00ff00ff00ff)
+
+
+def test_find_in_empty_tree():
+    assert BKTree().find(0x0f0f0f0f0f0f0f0f, 64) is None
+
+
+def test_flat_hashes_are_not_distinctive():
+    assert not distinctive_perceptual_hash(0)
+    assert not distinctive_perceptual_hash(0xffffffffffffffff)
+    assert not distinctive_perceptual_hash(0x7f)
+    assert distinctive_perceptual_hash(0x0f0f0f0f0f0f0f0f)
+
+
+def test_flat_images_are_not_near_duplicates(tmp_path):
+    recorder = PostRecorder(str(tmp_path / 'cache.csv'), LOGGER)
+    recorder.log_post('abc', 'https://mastodon.example/@bot/1', '',
+                      PERCEPTUAL_HASH_PREFIX + '0000000000000000')
+    recorder.log_post('def', 'https://mastodon.example/@bot/2', '',
+                      PERCEPTUAL_HASH_PREFIX + '0f0f0f0f0f0f0f0f')
+
+    assert not recorder.near_duplicate_check(PERCEPTUAL_HASH_PREFIX + '0000000000000001', 6)
+    assert recorder.near_duplicate_check(PERCEPTUAL_HASH_PREFIX + '0f0f0f0f0f0f0f0e', 6)
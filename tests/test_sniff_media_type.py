@@ -0,0 +1,30 @@
+"""
+Tests for sniff_media_type in collect.py
+"""
+import pytest
+
+from collect import sniff_media_type
+
+
+@pytest.mark.parametrize('first_bytes, expected', [
+    (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR', 'image/png'),
+    (b'\xff\xd8\xff\xe0\x00\x10JFIF\x00', 'image/jpeg'),
+    (b'GIF89a\x01\x00\x01\x00\x00\x00', 'image/gif'),
+    (b'GIF87a\x01\x00\x01\x00\x00\x00', 'image/gif'),
+    (b'RIFF\x24\x00\x00\x00WEBPVP8 ', 'image/webp'),
+    (b'\x00\x00\x00\x20ftypisom\x00\x00', 'video/mp4'),
+    (b'\x00\x00\x00\x1cftypavif\x00\x00', 'image/avif'),
+    (b'\x00\x00\x00\x18ftypheic\x00\x00', 'image/heic'),
+    (b'\x1a\x45\xdf\xa3\x9f\x42\x86\x81\x01', 'video/webm'),
+])
+def test_known_signatures(first_bytes, expected):
+    assert sniff_media_type(first_bytes) == expected
+
+
+@pytest.mark.parametrize('first_bytes', [
+    b'<!DOCTYPE html><html>',
+    b'RIFF\x24\x00\x00\x00WAVEfmt ',
+    b'',
+])
+def test_unsupported_files(first_bytes):
+    assert sniff_media_type(first_bytes) is None
@@ -0,0 +1,33 @@
+"""
+Tests for TokenBucket in publish.py
+"""
+from publish import TokenBucket
+
+
+def test_starts_full_with_burst_tokens():
+    bucket = TokenBucket(rate=3, window=60, burst=2)
+    assert bucket.available()
+    bucket.consume()
+    assert bucket.available()
+    bucket.consume()
+    assert not bucket.available()
+
+
+def test_refills_at_rate_per_window():
+    bucket = TokenBucket(rate=3, window=60, burst=2)
+    bucket.consume()
+    bucket.consume()
+    assert 19 < bucket.seconds_until_available() <= 20
+
+    # Pretend 20 seconds have passed
+    bucket.last_fill -= 20
+    assert bucket.available()
+    assert bucket.seconds_until_available() == 0
+
+
+def test_never_holds_more_than_burst():
+    bucket = TokenBucket(rate=1, window=1, burst=2)
+    bucket.last_fill -= 3600
+    bucket.consume()
+    bucket.consume()
+    assert not bucket.available()